@@ -23,46 +23,41 @@
 import os
 import sys
 import traceback
+import queue
 import web  # web.py framework
 import gv  # Get access to SIP's settings
 from urls import urls  # Get access to SIP's URLs
 from sip import template_render  # Needed for working with web.py templates
 from webpages import ProtectedPage  # Needed for security
 import json  # for working with data file
+import sqlite3  # door event history
+from types import MappingProxyType
 import time
 from datetime import datetime, timedelta
-import math
-from helpers import jsave
 from helpers import timestr
 from helpers import restart
-from gpio_pins import GPIO
-from random import randint
-from threading import Thread
-
-
-#
-# TODO FIXME : create a new email method to use Google apps API instead of smtplib
-#              See how-to here: https://developers.google.com/gmail/api/quickstart/python
-#                               https://stackoverflow.com/questions/25944883/how-to-send-an-email-through-gmail-without-enabling-insecure-access
-#
-import smtplib
-import ssl
-
 try:
-    from twilio.rest import TwilioRestClient
-    TWILIO_EN = True
-except:
-    print(u"From Garage Plugin:")
-    print(u"Twilio lib not installed. Twilio SMS send will not work")
-    print(u"Use pip to install the twilio python library, or")
-    print(u"download the twilio-python library from http://twilio.com/docs/libraries")
-    TWILIO_EN = False
+    from gpio_pins import GPIO
+    _gpio_error = None
+except ImportError as err:
+    GPIO = None  # no RPi.GPIO on this machine
+    _gpio_error = err
+try:
+    from gpio_pins import pi  # pigpio connection, if gv.use_pigpio
+except ImportError:
+    pi = None
+from random import randint, Random, uniform
+from threading import Thread, Lock, RLock, Event, Condition
+import heapq
+import bisect
+import logging
+import logging.handlers
+from collections import deque, namedtuple
 
-# TODO FIXME : add support for "pi" gpio_pins. Only supporting GPIO for now...
-# if gv.use_pigpio:
-#     from gpio_pins import pi
-# else:
-#     from gpio_pins import GPIO
+
+# The notification backends (see NOTIFIERS) import what they need, e.g.
+# smtplib, ssl or http.client, on first use, so a channel that is not
+# enabled costs nothing at start-up.
 
 
 #
@@ -70,62 +65,1874 @@ except:
 #
 DATA_FILE = "./data/garage.json"
 
+#
+# Notifications are handed to a small pool of worker threads, so door
+# handling never waits on the network. Timeouts are in seconds.
+#
+NOTIFY_WORKERS = 2         # number of notification worker threads
+NOTIFY_QUEUE_SIZE = 32     # pending notifications; more than this are dropped
+NOTIFY_STOP_TIMEOUT = 2    # time a notification worker or the outbox busy sending is waited for on stop
+MAIL_TIMEOUT = 20          # SMTP connect/send timeout
+SMS_TIMEOUT = 20           # Twilio request timeout
+SMTP_IDLE_TIMEOUT = 300    # idle time after which a cached SMTP connection is closed
+TWILIO_API = "https://api.twilio.com"  # Twilio REST API base URL
+SMS_RATE = 1.0             # sustained SMS per second; faster sends wait their turn
+SMS_BURST = 3              # SMS that may be sent back to back before rate limiting
+OUTBOX_FILE = "./data/garage_outbox.db"  # notifications waiting to be retried
+OUTBOX_RETRY = 30          # first retry of a failed notification, seconds; doubles per attempt
+OUTBOX_RETRY_MAX = 3600    # longest wait between retries, seconds
+OUTBOX_JITTER = 0.25       # retry waits vary by up to +/- this fraction
+OUTBOX_MAX_AGE = 86400     # failed notifications older than this are dropped, seconds
+OUTBOX_BATCH = 20          # spooled messages of a channel retried in one batch
+OUTBOX_LEASE = 300         # a claimed channel is left alone this long by other outboxes, seconds
+HOOK_TIMEOUT = 10          # webhook request timeout
+NOTIFY_LOG = "./data/garage_notify.log"  # notifications written by the 'file' channel
+STATUS_LOG_SIZE = 200      # status records kept in memory
+STATUS_SHOW = 50           # most recent status records shown on the settings page
+STATUS_LOG_FILE = "./data/garage.log"  # written when 'log_file' is enabled in settings
+STATUS_LOG_BYTES = 65536   # size at which the status log file is rotated
+STATUS_LOG_BACKUPS = 2     # rotated status log files kept
+API_EVENTS = 20            # recent status records returned by the status API by default
+SSE_CLIENTS = 3            # concurrent Server-Sent Events clients; a new one ends the oldest
+SSE_CLIENT_BUFFER = 32     # events buffered per SSE client; the oldest are dropped when full
+SSE_HEARTBEAT = 3          # seconds between SSE heartbeats; also how soon a gone client is noticed
+HISTORY_FILE = "./data/garage_history.db"  # door event history
+HISTORY_FLUSH = 60         # seconds events are batched in memory before being written
+HISTORY_BATCH = 50         # pending events that force an early write
+HISTORY_SPAN = 86400       # default time range of a history query, seconds
+STATE_FILE = "./data/garage_state.json"  # warm-restart snapshot of door state and nag counters
+STATE_SAVE_DELAY = 30      # seconds changes are coalesced before the snapshot is written
+SETTINGS_SAVE_DELAY = 5    # seconds settings changes are coalesced before the data file is written
+STATS_FILE = "./data/garage_stats.json"  # hourly and daily usage rollups
+STATS_FLUSH = 300          # seconds between writes of the usage rollups
+STATS_HOURS = 168          # hourly rollups kept
+STATS_DAYS = 400           # daily rollups kept
+LOOP_RETRY = 5             # wait after an error in the monitor loop, seconds; doubles per error
+LOOP_RETRY_MAX = 300       # longest wait after repeated monitor loop errors, seconds
+DOOR_MOVE_TIMEOUT = 60     # seconds a door may take to move until its travel time is learned
+TRAVEL_SAMPLES = 20        # recent door travel times kept per door
+TRAVEL_MIN_SAMPLES = 3     # travel times needed before the learned timeout is used
+TRAVEL_SIGMAS = 4          # a move is overdue this many standard deviations past the mean travel time
+TRAVEL_SLACK = 2           # seconds added to the learned travel timeout
+TRAVEL_MIN = 1             # seconds; shorter moves (a press that only stopped the door) are not learned
+SENSOR_BOUNCETIME = 50     # ms; GPIO-level edge filter, debouncing is done by the edge thread
+SAMPLE_HYSTERESIS = 0.25   # polled sensors change level past 1/2 +/- this share of 1 samples; 0 is a majority vote
+RELAY_HOLD = 0.2           # seconds a relay is held on for a button press
+RELAY_GAP = 0.5            # seconds a relay stays off before a queued press of it is pulsed
+
+
+# Metrics
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # seconds
+
 #
 # Plugin menu entries ['Menu Name', 'URL'], (Optional)
 #
+# (a "Garage Button n" entry is added for each configured relay, see register_menus)
 gvmenu_settings = [u"Garage Doors Settings" , u"/garage-s" ]
-gvmenu_button1  = [u"Garage Button 1"       , u"/garage-b1"]
-gvmenu_button2  = [u"Garage Button 2"       , u"/garage-b2"]
 
 plugin_urls = [
-    u"/garage-b1",   u"plugins.garage.garage_button_1",
-    u"/garage-b2",   u"plugins.garage.garage_button_2",
+    u"/garage-b([0-9]+)", u"plugins.garage.garage_button",
     u"/garage-s",    u"plugins.garage.settings",
     u"/garage-save", u"plugins.garage.save_settings",
-    u"/garage-stn",  u"plugins.garage.garage_stop_nagging"
+    u"/garage-stn",  u"plugins.garage.garage_stop_nagging",
+    u"/garage-api/status", u"plugins.garage.api_status",
+    u"/garage-api/press",  u"plugins.garage.api_press",
+    u"/garage-api/stn",    u"plugins.garage.api_stop_nagging",
+    u"/garage-api/events", u"plugins.garage.api_events",
+    u"/garage-api/history", u"plugins.garage.api_history",
+    u"/garage-api/metrics", u"plugins.garage.api_metrics",
+    u"/garage-api/notifiers", u"plugins.garage.api_notifiers",
+    u"/garage-api/sensors", u"plugins.garage.api_sensors",
+    u"/garage-api/stats", u"plugins.garage.api_stats"
 ]
 
+###############################################################################
+# Metrics
+#
+class Counter(object):
+    """
+    Monotonic counter, optionally split by label values.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}  # label values -> count
+        self._lock = Lock()
+
+    def inc(self, *label_values, n=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + n
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        if not values and not self.labels:
+            values = [((), 0)]
+        for label_values, v in values:
+            yield self.name, dict(zip(self.labels, label_values)), v
+
+
+class Histogram(object):
+    """
+    Fixed-bucket histogram of durations in seconds. observe() is a bisect
+    and three additions under a lock, cheap enough for the hot paths.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)  # last one is +Inf
+        self._sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    def time(self):
+        """
+        Context manager that observes the time.monotonic() duration of its block.
+        """
+        return _HistogramTimer(self)
+
+    def samples(self):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        cumulative = 0
+        for le, c in zip(self.buckets + ('+Inf',), counts):
+            cumulative += c
+            yield self.name + '_bucket', {'le': str(le)}, cumulative
+        yield self.name + '_sum', {}, total
+        yield self.name + '_count', {}, cumulative
+
+
+class _HistogramTimer(object):
+    __slots__ = ('hist', 'start')
+
+    def __init__(self, hist):
+        self.hist = hist
+
+    def __enter__(self):
+        self.start = time.monotonic()
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.monotonic() - self.start)
+
+
+class Gauge(object):
+    """
+    Value read when the metrics are scraped; fn returns a number, or a
+    dict of label value -> number.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help, fn, label=None):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.label = label
+
+    def samples(self):
+        value = self.fn()
+        if self.label is None:
+            yield self.name, {}, value
+        else:
+            for k in sorted(value):
+                yield self.name, {self.label: k}, value[k]
+
+
+class Metrics(object):
+    """
+    The plugin's metrics, rendered in the Prometheus text exposition format.
+    """
+    def __init__(self):
+        self._metrics = []
+
+    def add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for m in self._metrics:
+            lines.append('# HELP %s %s' % (m.name, m.help))
+            lines.append('# TYPE %s %s' % (m.name, m.kind))
+            try:
+                for name, labels, value in m.samples():
+                    if labels:
+                        name += '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                                  for k, v in sorted(labels.items()))
+                    lines.append('%s %s' % (name, repr(float(value)) if isinstance(value, float) else value))
+            except Exception as err:
+                lines.append('# %s: %s' % (m.name, err))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+edge_seconds = metrics.add(Histogram('garage_edge_to_state_seconds',
+                                     'Sensor edge to door state update, including the settle time.'))
+press_seconds = metrics.add(Histogram('garage_press_seconds', 'Duration of press_button().'))
+press_relay_seconds = metrics.add(Histogram('garage_press_to_relay_seconds',
+                                            'Button press to relay output switching on.'))
+toggle_seconds = metrics.add(Histogram('garage_relay_toggle_seconds', 'Time a relay was held on for a press.'))
+email_seconds = metrics.add(Histogram('garage_email_send_seconds', 'Duration of send_email_insec().'))
+sms_seconds = metrics.add(Histogram('garage_sms_send_seconds', 'Duration of send_sms().'))
+notify_seconds = metrics.add(Histogram('garage_notify_delivery_seconds',
+                                       'try_notify() to a channel accepting the notification.'))
+notifications = metrics.add(Counter('garage_notifications_total',
+                                    'Notifications handed to a channel, by channel and result.',
+                                    ('channel', 'result')))
+notifications_coalesced = metrics.add(Counter('garage_notifications_coalesced_total',
+                                              'Notifications merged, dropped as duplicates or held for the digest.',
+                                              ('action',)))
+notifications_dropped = metrics.add(Counter('garage_notifications_dropped_total',
+                                            'Notifications dropped because the queue was full.'))
+sensor_edges = metrics.add(Counter('garage_sensor_edges_total', 'Sensor edges received from GPIO.'))
+loop_iterations = metrics.add(Counter('garage_loop_iterations_total', 'Controller loop iterations.'))
+metrics.add(Gauge('garage_door_open', 'Door is open (1) or not (0).',
+                  lambda: dict((n, int(s in OPEN_STATES)) for n, s in controller._door_state.items()), 'door'))
+metrics.add(Gauge('garage_nagging', 'A door is still nagging (1) or not (0).', lambda: int(gv.gc_nag)))
+metrics.add(Gauge('garage_outbox', 'Failed notifications waiting to be retried, by channel.',
+                  lambda: controller.outbox.pending(), 'channel'))
+metrics.add(Gauge('garage_notify_queue', 'Notifications waiting for a worker.',
+                  lambda: controller.notifier.pending()))
+
+
+###############################################################################
+# Notification dispatcher
+#
+class NotifyDispatcher(object):
+    """
+    Bounded notification queue served by a small pool of worker threads.
+    Callers only enqueue; the workers call deliver(*args) for each item.
+    If the queue is full, the notification is dropped rather than
+    blocking the caller.
+    """
+    def __init__(self, deliver, workers=NOTIFY_WORKERS, maxsize=NOTIFY_QUEUE_SIZE):
+        self._deliver = deliver
+        self._nworkers = workers
+        self._queue = queue.Queue(maxsize)
+        self._workers = []
+        self.dropped = 0
+
+    def start(self):
+        for i in range(self._nworkers):
+            t = Thread(target=self._work, name='garage-notify-%d' % i)
+            t.daemon = True
+            t.start()
+            self._workers.append(t)
+
+    def submit(self, *args):
+        """
+        Queue a notification. Returns False if it was dropped.
+        """
+        try:
+            self._queue.put_nowait(args)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._deliver(*item)
+            except Exception as err:
+                print('Error: notification worker: ' + str(err))
+            finally:
+                self._queue.task_done()
+
+    def flush(self, timeout=None):
+        """
+        Wait until every queued notification has been handled.
+        Returns False if the timeout expired first.
+        """
+        q = self._queue
+        end = None if timeout is None else time.time() + timeout
+        with q.all_tasks_done:
+            while q.unfinished_tasks:
+                if end is None:
+                    q.all_tasks_done.wait()
+                else:
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        return False
+                    q.all_tasks_done.wait(remaining)
+        return True
+
+    def stop(self, timeout=NOTIFY_STOP_TIMEOUT):
+        """
+        Stop the workers, and return the notifications they had not started
+        on (as the args given to submit), for the caller to keep. A worker
+        still sending after timeout is left to finish on its own.
+        """
+        left = []
+        while True:
+            try:
+                left.append(self._queue.get_nowait())
+                self._queue.task_done()
+            except queue.Empty:
+                break
+        for t in self._workers:
+            self._queue.put(None)
+        end = time.monotonic() + timeout
+        for t in self._workers:
+            t.join(max(0, end - time.monotonic()))
+        self._workers = []
+        return left
+
+
+###############################################################################
+# Notification outbox
+#
+class Outbox(object):
+    """
+    Durable spool, in SQLite, of notifications that could not be sent, so
+    they survive restarts. A thread retries the oldest messages of each
+    channel, up to batch at a time, with exponential backoff and jitter on
+    the oldest, so every channel drains in order once it works again.
+    Before a batch is sent, its oldest message is claimed by moving its
+    next_try lease seconds ahead, so another outbox on the same file (the
+    old one, while the plugin reloads) doesn't send the batch as well.
+    Messages older than max_age are dropped.
+    send(channel, messages) sends a list of (subject, text, attempts) in
+    order and returns how many were sent and the error that stopped it,
+    or None; report(msg, level) logs expired messages.
+    """
+    def __init__(self, send, report, path=OUTBOX_FILE, retry=OUTBOX_RETRY,
+                 retry_max=OUTBOX_RETRY_MAX, max_age=OUTBOX_MAX_AGE, batch=OUTBOX_BATCH, lease=OUTBOX_LEASE):
+        self.send = send
+        self.report = report
+        self.path = path
+        self.retry = retry
+        self.retry_max = retry_max
+        self.max_age = max_age
+        self.batch = batch
+        self.lease = lease
+        self._lock = Lock()
+        self._wake = Event()
+        self._halt = Event()
+        self._db = None
+        self._counts = {}  # channel -> messages spooled
+        self._thread = None
+
+    def _open(self):
+        if self._db is None:
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute('CREATE TABLE IF NOT EXISTS outbox '
+                       '(id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT NOT NULL, subject TEXT, text TEXT, '
+                       'created REAL NOT NULL, attempts INTEGER NOT NULL, next_try REAL NOT NULL, error TEXT)')
+            db.execute('CREATE INDEX IF NOT EXISTS outbox_channel ON outbox (channel, created, id)')
+            db.commit()
+            self._db = db
+            self._counts = dict(db.execute('SELECT channel, COUNT(*) FROM outbox GROUP BY channel'))
+        return self._db
+
+    def start(self):
+        with self._lock:
+            self._open()
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name='garage-outbox')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def backoff(self, attempts):
+        """
+        Seconds to wait after the given number of failed attempts.
+        """
+        delay = min(self.retry_max, self.retry * 2 ** max(0, attempts - 1))
+        return delay * uniform(1 - OUTBOX_JITTER, 1 + OUTBOX_JITTER)
+
+    def pending(self, channel=None):
+        with self._lock:
+            if channel is None:
+                return dict(self._counts)
+            return self._counts.get(channel, 0)
+
+    def add(self, channel, subject, text, created=None, attempts=0, error=None):
+        """
+        Spool a message. created is the time.time() the notification was
+        made, which orders the channel; attempts is how often it has failed
+        already.
+        """
+        now = time.time()
+        with self._lock:
+            db = self._open()
+            with db:
+                db.execute('INSERT INTO outbox (channel, subject, text, created, attempts, next_try, error) '
+                           'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           (channel, subject, text, now if created is None else created, attempts,
+                            now + self.backoff(attempts) if attempts else now, error))
+            self._counts[channel] = self._counts.get(channel, 0) + 1
+        if not self._halt.is_set():
+            self._wake.set()
+
+    def _remove(self, ids, channel):
+        with self._lock:
+            with self._db:
+                removed = self._db.executemany('DELETE FROM outbox WHERE id = ?', [(id,) for id in ids]).rowcount
+            self._counts[channel] = self._counts.get(channel, 0) - removed
+            if self._counts[channel] <= 0:
+                del self._counts[channel]
+
+    def _run(self):
+        try:
+            while not self._halt.is_set():
+                with self._lock:
+                    heads = self._db.execute('SELECT channel, next_try FROM outbox o '
+                                             'WHERE id = (SELECT id FROM outbox WHERE channel = o.channel '
+                                             'ORDER BY created, id LIMIT 1)').fetchall()
+                now = time.time()
+                due = [channel for channel, next_try in heads if next_try <= now]
+                if not due:
+                    # look again after retry seconds at most, for messages
+                    # another outbox on the file added
+                    self._wake.wait(min([self.retry] + [h[1] - now for h in heads]))
+                    self._wake.clear()
+                    continue
+                for channel in due:
+                    if self._halt.is_set():
+                        return
+                    self._retry(channel, now)
+        finally:
+            if self._halt.is_set():
+                self._close()
+
+    def _retry(self, channel, now):
+        with self._lock:
+            rows = self._db.execute('SELECT id, subject, text, created, attempts FROM outbox WHERE channel = ? '
+                                    'ORDER BY created, id LIMIT ?', (channel, self.batch)).fetchall()
+        expired = [r for r in rows if now - r[3] > self.max_age]
+        if expired:
+            self._remove([r[0] for r in expired], channel)
+            for id, subject, text, created, attempts in expired:
+                notifications.inc(channel, 'expired')
+                self.report("Outbox: %s notification dropped after %d attempts: %s" % (channel, attempts, text),
+                            'ERROR')
+        rows = [r for r in rows if now - r[3] <= self.max_age]
+        if not rows:
+            return
+        with self._lock:
+            with self._db:  # claim the batch; if another outbox did first, it isn't due any more
+                claimed = self._db.execute('UPDATE outbox SET next_try = ? WHERE id = ? AND next_try <= ?',
+                                           (now + self.lease, rows[0][0], now)).rowcount
+        if not claimed:
+            return
+        try:
+            sent, err = self.send(channel, [(subject, text, attempts) for id, subject, text, created, attempts in rows])
+        except Exception as e:
+            sent, err = 0, e
+        if sent:
+            self._remove([r[0] for r in rows[:sent]], channel)
+        if err is not None and sent < len(rows):
+            id, attempts = rows[sent][0], rows[sent][4]
+            with self._lock:
+                with self._db:
+                    self._db.execute('UPDATE outbox SET attempts = ?, next_try = ?, error = ? WHERE id = ?',
+                                     (attempts + 1, time.time() + self.backoff(attempts + 1), str(err), id))
+
+    def halt(self):
+        """
+        Ask the retry thread to stop once it is done with the batch it may
+        be sending. Messages added from now on stay in the file.
+        """
+        self._halt.set()
+        self._wake.set()
+
+    def stop(self, timeout=NOTIFY_STOP_TIMEOUT):
+        """
+        Stop the retry thread. If it is still sending after timeout, it is
+        left to finish the batch (which it has claimed) and close the file.
+        """
+        self.halt()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                return
+        self._close()
+
+    def _close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+###############################################################################
+# Notification coalescing
+#
+class NotifyCoalescer(object):
+    """
+    Sits in front of the notification dispatcher, so a flapping sensor or
+    a door left open doesn't turn into a burst of emails and SMS:
+      - the first notification for a door goes out at once and opens a
+        window; the door's further notifications within the window are
+        merged into one message, sent when the window closes,
+      - a repeat of the last notification of the same door (or of the same
+        text, if it isn't about a door) within the window is dropped,
+      - with a digest interval, low priority reminders are held and sent
+        together once per interval.
+    submit(subject, text, queued) hands a message on to the dispatcher;
+    the windows and the digest are timers of the controller's scheduler.
+    """
+    def __init__(self, submit, timers):
+        self._submit = submit
+        self._timers = timers
+        self._lock = Lock()
+        self._windows = {}  # door -> [subject, lines held, time.monotonic() of the first one]
+        self._last = {}     # door or (subject, text) -> (text, time.monotonic()) of the last one passed on
+        self._digest = []   # (subject, line) held for the digest
+
+    def add(self, subject, text, stamp, door=None, low=False, window=0, digest=0):
+        """
+        text is the message, stamp when it happened. Returns what was done
+        with it: 'sent', 'merged', 'duplicate' or 'digest'.
+        """
+        now = time.monotonic()
+        body = text.strip()
+        line = "%s (%s)" % (body, stamp)
+        with self._lock:
+            if window:
+                key = door if door is not None else (subject, body)
+                last = self._last.get(key)
+                if last is not None and last[0] == body and now - last[1] < window:
+                    notifications_coalesced.inc('duplicate')
+                    return 'duplicate'
+                self._last[key] = (body, now)  # only passed on messages restart the window
+                if len(self._last) > 100:
+                    self._last = dict((k, v) for k, v in self._last.items() if now - v[1] < window)
+            if low and digest:
+                if not self._digest:
+                    self._timers.schedule(time.time() + digest, 'digest', self.flush_digest)
+                self._digest.append((subject, line))
+                notifications_coalesced.inc('digest')
+                return 'digest'
+            if door is not None and window:
+                held = self._windows.get(door)
+                if held is not None:
+                    held[1].append(line)
+                    notifications_coalesced.inc('merged')
+                    return 'merged'
+                self._windows[door] = [subject, [], now]
+                self._timers.schedule(time.time() + window, ('notify', door), self.close_window, door, window)
+        self._submit(subject, text + "\nOn " + stamp, now)
+        return 'sent'
+
+    def close_window(self, door, window):
+        """
+        Send what was held for door as one message. If anything was, keep
+        coalescing for another window.
+        """
+        with self._lock:
+            held = self._windows.get(door)
+            if held is None:
+                return
+            subject, lines, first = held
+            if lines:
+                self._windows[door] = [subject, [], time.monotonic()]
+                self._timers.schedule(time.time() + window, ('notify', door), self.close_window, door, window)
+            else:
+                del self._windows[door]
+        self._send_held(door, subject, lines, first)
+
+    def _send_held(self, door, subject, lines, first):
+        if lines:
+            self._submit(subject, "Door %s, %d more:\n%s" % (door, len(lines), "\n".join(lines)), first)
+
+    def flush_digest(self):
+        with self._lock:
+            held, self._digest = self._digest, []
+        if held:
+            self._submit(held[0][0] + " digest", "\n".join(line for subject, line in held), time.monotonic())
+
+    def flush(self):
+        """
+        Send everything held, e.g. before shutting down.
+        """
+        with self._lock:
+            windows, self._windows = self._windows, {}
+        for door, (subject, lines, first) in windows.items():
+            self._timers.cancel(('notify', door))
+            self._send_held(door, subject, lines, first)
+        self._timers.cancel('digest')
+        self.flush_digest()
+
+
+###############################################################################
+# Status log
+#
+StatusRecord = namedtuple('StatusRecord', 'ts level door msg')
+
+class StatusLog(object):
+    """
+    Fixed-capacity ring buffer of structured status records, with optional
+    output to a rotating log file. Readers only ever see the last N records.
+    """
+    def __init__(self, size=STATUS_LOG_SIZE):
+        self._records = deque(maxlen=size)
+        self._lock = Lock()
+        self._file = None  # logging.Logger while file output is on
+        self.seq = 0  # number of records ever added
+
+    def add(self, msg, level='INFO', door=None):
+        rec = StatusRecord(time.time(), level, door, msg)
+        with self._lock:
+            self._records.append(rec)
+            self.seq += 1
+        if self._file is not None:
+            self._file.log(getattr(logging, level, logging.INFO), self.format(rec))
+        return rec
+
+    def last(self, n=STATUS_SHOW):
+        with self._lock:
+            records = list(self._records)
+        return records[-n:] if n else records
+
+    @staticmethod
+    def format(rec):
+        return 'STATUS: ' + time.strftime("%d.%m.%Y at %H:%M:%S", time.localtime(rec.ts)) + ': ' + rec.msg
+
+    def text(self, n=STATUS_SHOW):
+        return '\n'.join(self.format(rec) for rec in self.last(n))
+
+    def set_file(self, path):
+        """
+        Start writing records to a rotating file at path, or stop if path is None.
+        """
+        logger = logging.getLogger('garage.status')
+        for h in list(logger.handlers):
+            logger.removeHandler(h)
+            h.close()
+        self._file = None
+        if path:
+            handler = logging.handlers.RotatingFileHandler(path, maxBytes=STATUS_LOG_BYTES,
+                                                           backupCount=STATUS_LOG_BACKUPS)
+            handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+            logger.addHandler(handler)
+            logger.setLevel(logging.DEBUG)
+            logger.propagate = False
+            self._file = logger
+
+
+###############################################################################
+# Server-Sent Events
+#
+class EventClient(object):
+    """
+    Bounded event buffer of one SSE client. When it is full the oldest
+    event is dropped, so a slow client never backs up the controller.
+    """
+    def __init__(self, size=SSE_CLIENT_BUFFER):
+        self._events = deque(maxlen=size)
+        self._cond = Condition()
+        self.closed = False
+        self.dropped = 0
+
+    def push(self, event):
+        with self._cond:
+            if len(self._events) == self._events.maxlen:
+                self.dropped += 1
+            self._events.append(event)
+            self._cond.notify()
+
+    def get(self, timeout):
+        """
+        Next event, or None if nothing arrived within timeout seconds.
+        """
+        with self._cond:
+            if not self._events and not self.closed:
+                self._cond.wait(timeout)
+            return self._events.popleft() if self._events else None
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+
+
+class EventBroker(object):
+    """
+    Fans controller events (door transitions, relay presses, notification
+    outcomes) out to the connected SSE clients. publish() never blocks.
+    """
+    def __init__(self, max_clients=SSE_CLIENTS):
+        self.max_clients = max_clients
+        self._clients = []         # oldest first
+        self._lock = Lock()
+        self._seq = 0
+
+    def subscribe(self):
+        """
+        Returns a new EventClient. When there are already max_clients, the
+        oldest is closed to make room: it is most likely a tab that has
+        gone away and whose stream has not noticed yet.
+        """
+        client = EventClient()
+        with self._lock:
+            evicted = self._clients[:max(0, len(self._clients) + 1 - self.max_clients)]
+            del self._clients[:len(evicted)]
+            self._clients.append(client)
+        for old in evicted:
+            old.close()
+        return client
+
+    def unsubscribe(self, client):
+        with self._lock:
+            if client in self._clients:
+                self._clients.remove(client)
+        client.close()
+
+    def publish(self, kind, data):
+        with self._lock:
+            self._seq += 1
+            event = (self._seq, kind, json.dumps(data))
+            clients = list(self._clients)
+        for client in clients:
+            client.push(event)
+
+    def close(self):
+        with self._lock:
+            clients = list(self._clients)
+            self._clients.clear()
+        for client in clients:
+            client.close()
+
+
+###############################################################################
+# Door event history
+#
+OPEN_STATES = ('OPEN', 'OPENING', 'CLOSING', 'STALLED')  # door states in which the door is not closed
+
+class EventHistory(object):
+    """
+    Append-only store of door state changes and relay presses, kept in
+    SQLite with a time index. Events are batched in memory and written
+    in one transaction per flush, to keep SD-card writes down. Queries
+    see pending events too.
+    """
+    def __init__(self, path=HISTORY_FILE):
+        self.path = path
+        self._pending = []
+        self._lock = Lock()
+        self._db = None
+
+    def _open(self):
+        if self._db is None:
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute('CREATE TABLE IF NOT EXISTS events '
+                       '(ts REAL NOT NULL, door TEXT NOT NULL, kind TEXT NOT NULL, state TEXT)')
+            db.execute('CREATE INDEX IF NOT EXISTS events_ts ON events (ts)')
+            db.execute('CREATE INDEX IF NOT EXISTS events_door_ts ON events (door, ts)')
+            db.commit()
+            self._db = db
+        return self._db
+
+    def record(self, door, kind, state, ts=None):
+        """
+        Queue an event. kind is 'state' for a door state change, or 'press'.
+        Returns True once enough events are pending that a flush is due.
+        """
+        with self._lock:
+            self._pending.append((time.time() if ts is None else ts, door, kind, state))
+            return len(self._pending) >= HISTORY_BATCH
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return
+            db = self._open()
+            with db:
+                db.executemany('INSERT INTO events VALUES (?, ?, ?, ?)', self._pending)
+            self._pending = []
+
+    def events(self, start, end, door=None, kind=None):
+        """
+        Events with start <= ts < end, oldest first, as (ts, door, kind, state).
+        """
+        sql = 'SELECT ts, door, kind, state FROM events WHERE ts >= ? AND ts < ?'
+        args = [start, end]
+        if door is not None:
+            sql += ' AND door = ?'
+            args.append(door)
+        if kind is not None:
+            sql += ' AND kind = ?'
+            args.append(kind)
+        with self._lock:
+            rows = self._open().execute(sql + ' ORDER BY ts', args).fetchall()
+            rows += [e for e in self._pending if start <= e[0] < end and
+                     (door is None or e[1] == door) and (kind is None or e[2] == kind)]
+        rows.sort()
+        return rows
+
+    def state_at(self, door, ts):
+        """
+        Last recorded state of door at time ts, or None.
+        """
+        with self._lock:
+            for e in reversed(self._pending):
+                if e[1] == door and e[2] == 'state' and e[0] <= ts:
+                    return e[3]
+            row = self._open().execute('SELECT state FROM events WHERE door = ? AND kind = ? AND ts <= ? '
+                                       'ORDER BY ts DESC LIMIT 1', (door, 'state', ts)).fetchone()
+        return row[0] if row else None
+
+    def open_intervals(self, start, end, door):
+        """
+        [opened, closed] intervals of door clipped to start..end. closed is None
+        if the door was still open at end.
+        """
+        intervals = []
+        opened = start if self.state_at(door, start) in OPEN_STATES else None
+        for ts, _, _, state in self.events(start, end, door, 'state'):
+            if state in OPEN_STATES:
+                if opened is None:
+                    opened = ts
+            elif opened is not None:
+                intervals.append([opened, ts])
+                opened = None
+        if opened is not None:
+            intervals.append([opened, None])
+        return intervals
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+###############################################################################
+# Deadline scheduler
+#
+class DeadlineScheduler(object):
+    """
+    Heap of one-shot timers, keyed so that scheduling a key again replaces
+    its previous timer (stale heap entries are skipped when they surface).
+    The controller thread sleeps in wait() until the earliest deadline, or
+    until a timer is added or wake() is called from another thread.
+    Deadlines are time.time() values.
+    """
+    def __init__(self):
+        self._heap = []
+        self._live = {}  # key -> sequence number of its current heap entry
+        self._seq = 0
+        self._lock = Lock()
+        self._wake = Event()
+
+    def schedule(self, when, key, callback, *args):
+        with self._lock:
+            self._seq += 1
+            self._live[key] = self._seq
+            heapq.heappush(self._heap, (when, self._seq, key, callback, args))
+        self._wake.set()
+
+    def cancel(self, key):
+        with self._lock:
+            self._live.pop(key, None)
+
+    def wake(self):
+        self._wake.set()
+
+    def _next(self):
+        # drop cancelled or replaced entries from the top of the heap
+        while self._heap:
+            when, seq, key = self._heap[0][:3]
+            if self._live.get(key) == seq:
+                return when
+            heapq.heappop(self._heap)
+        return None
+
+    def next_deadline(self):
+        with self._lock:
+            return self._next()
+
+    def wait(self, max_wait=None):
+        """
+        Sleep until the next deadline, a wake-up, or max_wait seconds.
+        """
+        when = self.next_deadline()
+        timeout = max_wait
+        if when is not None:
+            timeout = max(0, when - time.time())
+            if max_wait is not None:
+                timeout = min(timeout, max_wait)
+        self._wake.wait(timeout)
+        self._wake.clear()
+
+    def run_due(self):
+        """
+        Run every timer whose deadline has passed, earliest first.
+        """
+        while True:
+            with self._lock:
+                when = self._next()
+                if when is None or when > time.time():
+                    return
+                when, seq, key, callback, args = heapq.heappop(self._heap)
+                del self._live[key]
+            callback(*args)
+
+
+###############################################################################
+# Simulated GPIO
+#
+class FakeGPIO(object):
+    """
+    Drop-in stand-in for RPi.GPIO, so the plugin can run on a machine
+    without GPIO when GARAGE_GPIO=fake is set (see tools/bench_garage.py). Sensors are
+    driven with set_input(), replay() or storm(). Edge callbacks run on a
+    single thread and honor bouncetime, like RPi.GPIO's.
+    """
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self):
+        self._lock = Lock()
+        self.levels = {}
+        self.modes = {}
+        self._detect = {}  # pin -> [edge, callback, bouncetime (s), time of last callback]
+        self._calls = queue.Queue()
+        self._thread = None
+        self.outputs = deque(maxlen=1000)  # (monotonic time, pin, level) of every output()
+        self.on_output = None  # optional hook, called as on_output(pin, level, monotonic time)
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, mode, pull_up_down=None, initial=None):
+        with self._lock:
+            self.modes[pin] = mode
+            if mode == self.IN:
+                self.levels.setdefault(pin, self.HIGH if pull_up_down == self.PUD_UP else self.LOW)
+            else:
+                self.levels[pin] = self.LOW if initial is None else initial
+
+    def input(self, pin):
+        try:
+            return self.levels[pin]
+        except KeyError:
+            raise RuntimeError(u"You must setup() the GPIO channel first")
+
+    def output(self, pin, value):
+        if self.modes.get(pin) != self.OUT:
+            raise RuntimeError(u"The GPIO channel has not been set up as an OUTPUT")
+        now = time.monotonic()
+        self.levels[pin] = value
+        self.outputs.append((now, pin, value))
+        if self.on_output is not None:
+            self.on_output(pin, value, now)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        with self._lock:
+            if pin in self._detect:
+                raise RuntimeError(u"Conflicting edge detection already enabled for this GPIO channel")
+            self._detect[pin] = [edge, callback, (bouncetime or 0) / 1000.0, None]
+            if self._thread is None:
+                self._thread = Thread(target=self._dispatch, name='fake-gpio')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def remove_event_detect(self, pin):
+        with self._lock:
+            self._detect.pop(pin, None)
+
+    def cleanup(self, pin=None):
+        with self._lock:
+            for p in ([pin] if pin is not None else list(self.modes)):
+                self._detect.pop(p, None)
+                self.modes.pop(p, None)
+                self.levels.pop(p, None)
+
+    def set_input(self, pin, level):
+        """
+        Drive input pin to level, as its sensor would.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self.levels.get(pin) == level:
+                return
+            self.levels[pin] = level
+            detect = self._detect.get(pin)
+            if detect is None or detect[1] is None:
+                return
+            edge = self.RISING if level else self.FALLING
+            if detect[0] not in (edge, self.BOTH):
+                return
+            if detect[3] is not None and now - detect[3] < detect[2]:
+                return  # inside bouncetime
+            detect[3] = now
+            callback = detect[1]
+        self._calls.put((callback, pin))
+
+    def _dispatch(self):
+        while True:
+            callback, pin = self._calls.get()
+            try:
+                callback(pin)
+            except Exception as err:
+                print('Error: fake GPIO callback: ' + str(err))
+
+    def replay(self, script):
+        """
+        Play a list of (delay, pin, level) edges; each delay, in seconds,
+        counts from the previous edge.
+        """
+        for delay, pin, level in script:
+            if delay > 0:
+                time.sleep(delay)
+            self.set_input(pin, level)
+
+    def storm(self, pin, edges, interval=0.002, final=None, seed=None):
+        """
+        Bounce pin through edges random toggles, up to interval seconds
+        apart, ending at final (default: the opposite of its current level).
+        Returns the monotonic time of the last edge.
+        """
+        rnd = Random(seed)
+        level = self.levels.get(pin, self.LOW)
+        if final is None:
+            final = level ^ 1
+        script = []
+        for i in range(edges):
+            level ^= 1
+            script.append((rnd.uniform(0, interval), pin, level))
+        if level != final:
+            script.append((rnd.uniform(0, interval), pin, final))
+        self.replay(script)
+        return time.monotonic()
+
+
+###############################################################################
+# pigpio GPIO backend
+#
+# BOARD pin number -> BCM gpio number (40 pin header). Settings use BOARD
+# numbers, like the rest of SIP; pigpio only knows BCM numbers.
+BOARD_TO_BCM = {
+     3: 2,  5: 3,  7: 4,  8: 14, 10: 15, 11: 17, 12: 18, 13: 27,
+    15: 22, 16: 23, 18: 24, 19: 10, 21: 9,  22: 25, 23: 11, 24: 8,
+    26: 7,  27: 0,  28: 1,  29: 5,  31: 6,  32: 12, 33: 13, 35: 19,
+    36: 16, 37: 26, 38: 20, 40: 21,
+}
+
+class PigpioGPIO(object):
+    """
+    RPi.GPIO style front end to a pigpio.pi connection (SIP's gpio_pins.pi),
+    used when gv.use_pigpio is set.
+    Edges are timestamped by pigpiod in microseconds and reported with the
+    level pigpiod saw, so the callback gets callback(pin, level, monotonic
+    time of the edge). The bouncetime of add_event_detect() becomes a
+    pigpiod glitch filter, so contact bounce is dropped in the daemon.
+    """
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    # pigpio constants
+    _MODE = {OUT: 1, IN: 0}                     # pigpio.OUTPUT, pigpio.INPUT
+    _PUD = {PUD_OFF: 0, PUD_DOWN: 1, PUD_UP: 2}  # pigpio.PUD_OFF, PUD_DOWN, PUD_UP
+    _EDGE = {RISING: 0, FALLING: 1, BOTH: 2}    # pigpio.RISING_EDGE, FALLING_EDGE, EITHER_EDGE
+    _TIMEOUT = 2                                # level reported for a watchdog timeout
+    _MAX_GLITCH = 300000                        # us, pigpiod limit for set_glitch_filter
+    _RESYNC = 60                                # s, between tick clock re-anchors
+
+    def __init__(self, pi):
+        self.pi = pi
+        self._callbacks = {}  # BOARD pin -> pigpio callback
+        self._lock = Lock()
+        self._anchor = None   # (tick, monotonic time) read together
+
+    def bcm(self, pin):
+        try:
+            return BOARD_TO_BCM[pin]
+        except KeyError:
+            raise ValueError(u"Pin %s is not a GPIO pin" % pin)
+
+    def setup(self, pin, mode, pull_up_down=None, initial=None):
+        gpio = self.bcm(pin)
+        self.pi.set_mode(gpio, self._MODE[mode])
+        if mode == self.IN:
+            self.pi.set_pull_up_down(gpio, self._PUD[pull_up_down or self.PUD_OFF])
+        elif initial is not None:
+            self.pi.write(gpio, initial)
+
+    def input(self, pin):
+        return self.pi.read(self.bcm(pin))
+
+    def output(self, pin, value):
+        self.pi.write(self.bcm(pin), value)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        gpio = self.bcm(pin)
+        self.pi.set_glitch_filter(gpio, min(int((bouncetime or 0) * 1000), self._MAX_GLITCH))
+        self._tick_time(None)  # anchor the tick clock before the first edge
+
+        def edge_event(g, level, tick):
+            if level == self._TIMEOUT or callback is None:
+                return
+            callback(pin, level, self._tick_time(tick))
+
+        with self._lock:
+            if pin in self._callbacks:
+                raise RuntimeError(u"Conflicting edge detection already enabled for this GPIO channel")
+            self._callbacks[pin] = self.pi.callback(gpio, self._EDGE[edge], edge_event)
+
+    def remove_event_detect(self, pin):
+        with self._lock:
+            cb = self._callbacks.pop(pin, None)
+        if cb is not None:
+            cb.cancel()
+            self.pi.set_glitch_filter(self.bcm(pin), 0)
+
+    def _tick_time(self, tick):
+        """
+        time.monotonic() of a pigpio tick. Ticks are microseconds that wrap
+        every 2**32 us (about 72 minutes), so they are taken relative to an
+        anchor (a tick read together with time.monotonic()) that is renewed
+        every _RESYNC seconds.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._anchor is None or now - self._anchor[1] > self._RESYNC:
+                self._anchor = (self.pi.get_current_tick(), time.monotonic())
+            anchor_tick, anchor_time = self._anchor
+        if tick is None:
+            return anchor_time
+        dt = (tick - anchor_tick) & 0xFFFFFFFF
+        if dt >= 0x80000000:  # the edge came before the anchor
+            dt -= 0x100000000
+        return anchor_time + dt / 1e6
+
+
+###############################################################################
+# Usage statistics
+#
+STATS_FIELDS = ('open', 'cycles', 'longest', 'nags', 'presses')
+
+def stats_keys(ts):
+    """
+    The (hour, day) bucket keys of time ts: the epoch start of its hour,
+    and its local date.
+    """
+    return int(ts - ts % 3600), time.strftime('%Y-%m-%d', time.localtime(ts))
+
+
+def stats_spans(start, end):
+    """
+    Split start..end at hour boundaries and at local midnight, which need
+    not fall on an hour boundary (UTC+5:30, say), so every span lies in a
+    single hour and a single day bucket. Yields (start, stop) pairs.
+    """
+    while start < end:
+        t = time.localtime(start)
+        midnight = time.mktime((t.tm_year, t.tm_mon, t.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+        stop = min(end, start - start % 3600 + 3600, midnight)
+        yield start, stop
+        start = stop
+
+
+class UsageStats(object):
+    """
+    Hourly and daily usage rollups per door: seconds open, open cycles,
+    longest open interval (by the bucket it ended in), nags and presses.
+    Every update touches only the buckets it falls in, so answers don't
+    depend on how long we've been running. A bucket is a list in
+    STATS_FIELDS order; hours are keyed by their epoch start, days by
+    their local date, see stats_keys(). Changes are written by flush(), when there are any.
+    """
+    def __init__(self, path=STATS_FILE):
+        self.path = path
+        self._lock = Lock()
+        self._hourly = {}      # door -> {hour start: bucket}
+        self._daily = {}       # door -> {'YYYY-MM-DD': bucket}
+        self._open_since = {}  # door -> time the door opened, while it is open
+        self._dirty = False
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as fh:
+                data = json.load(fh)
+        except (IOError, ValueError):
+            return
+        with self._lock:
+            self._hourly = dict((n, dict((int(h), b) for h, b in hours.items()))
+                                for n, hours in data.get('hourly', {}).items())
+            self._daily = data.get('daily', {})
+            self._open_since = data.get('open_since', {})
+
+    def _buckets(self, door, ts):
+        hour, day = stats_keys(ts)
+        zero = [0] * len(STATS_FIELDS)
+        return (self._hourly.setdefault(door, {}).setdefault(hour, list(zero)),
+                self._daily.setdefault(door, {}).setdefault(day, list(zero)))
+
+    def _add(self, door, ts, field, value=1):
+        i = STATS_FIELDS.index(field)
+        for b in self._buckets(door, ts):
+            b[i] = round(b[i] + value, 2)
+        self._dirty = True
+
+    def _add_open(self, door, start, end):
+        for start, stop in stats_spans(start, end):
+            self._add(door, start, 'open', stop - start)
+
+    def state(self, door, old, new, ts):
+        """
+        A door state change. Entering an open state starts an open interval
+        (and, from CLOSED, a cycle); reaching CLOSED ends it. UNKNOWN
+        neither opens nor closes.
+        """
+        with self._lock:
+            if new in OPEN_STATES and door not in self._open_since:
+                self._open_since[door] = ts
+                if old == 'CLOSED':
+                    self._add(door, ts, 'cycles')
+                self._dirty = True
+            elif new == 'CLOSED' and door in self._open_since:
+                start = self._open_since.pop(door)
+                self._add_open(door, start, ts)
+                for b in self._buckets(door, ts):
+                    b[2] = max(b[2], round(ts - start, 2))
+                self._dirty = True
+
+    def nag(self, door, ts):
+        with self._lock:
+            self._add(door, ts, 'nags')
+
+    def press(self, door, ts):
+        with self._lock:
+            self._add(door, ts, 'presses')
+
+    def report(self, door, hours, days, now=None):
+        """
+        The last hours hourly and days daily buckets of door, oldest first,
+        with the time a door that is still open has been open so far.
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            hourly = dict((h, list(b)) for h, b in self._hourly.get(door, {}).items())
+            daily = dict((d, list(b)) for d, b in self._daily.get(door, {}).items())
+            since = self._open_since.get(door)
+        if since is not None:  # the open interval so far, in buckets of its own
+            for start, stop in stats_spans(since, now):
+                hour, day = stats_keys(start)
+                zero = [0] * len(STATS_FIELDS)
+                hourly.setdefault(hour, list(zero))[0] += stop - start
+                daily.setdefault(day, list(zero))[0] += stop - start
+        first_hour = int(now - now % 3600) - (hours - 1) * 3600
+        first_day = time.strftime('%Y-%m-%d', time.localtime(now - (days - 1) * 86400))
+        row = lambda key, name, b: dict([(name, key)] + [(f, round(v, 1)) for f, v in zip(STATS_FIELDS, b)])
+        return {
+            'open_since': since,
+            'hourly'    : [row(h, 'start', hourly[h]) for h in sorted(hourly) if h >= first_hour],
+            'daily'     : [row(d, 'date', daily[d]) for d in sorted(daily) if d >= first_day],
+        }
+
+    def flush(self, now=None):
+        """
+        Drop buckets past STATS_HOURS / STATS_DAYS and write the rollups, if
+        they changed.
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            if not self._dirty:
+                return
+            first_hour = now - STATS_HOURS * 3600
+            first_day = time.strftime('%Y-%m-%d', time.localtime(now - STATS_DAYS * 86400))
+            for hours in self._hourly.values():
+                for h in [h for h in hours if h < first_hour]:
+                    del hours[h]
+            for days in self._daily.values():
+                for d in [d for d in days if d < first_day]:
+                    del days[d]
+            data = json.dumps({'hourly': self._hourly, 'daily': self._daily, 'open_since': self._open_since},
+                              separators=(',', ':'), sort_keys=True)
+            self._dirty = False
+        try:
+            atomic_write(self.path, data)
+        except Exception:
+            self._dirty = True
+            raise
+
+
+###############################################################################
+# Relay actuator
+#
+class RelayActuator(object):
+    """
+    Single worker thread that owns the relay outputs. press() queues a
+    press and returns at once. The worker asks handler(button, pressed)
+    what the press does, which returns (pin, polarity, hold seconds) to
+    pulse or None, switches the relay on, and switches it off again from
+    a timer, so no thread sleeps through a pulse. Presses of a relay
+    within window seconds of the last accepted one are dropped, and a
+    press of a relay that is still pulsing waits until it is done.
+    report(msg, level) logs GPIO errors.
+    """
+    def __init__(self, gpio, handler, report, window=1.0, gap=RELAY_GAP):
+        self.gpio = gpio
+        self.handler = handler
+        self.report = report
+        self.window = window
+        self.gap = gap
+        self.duplicates = 0
+        self._lock = Lock()
+        self._last = {}     # button -> time.monotonic() of the last accepted press
+        self._commands = queue.Queue()
+        self._timers = DeadlineScheduler()
+        self._active = {}   # button -> (pin, polarity, time.monotonic() switched on), until the gap is over
+        self._waiting = {}  # button -> presses waiting for the relay
+        self._halt = Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name='garage-relays')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def press(self, button, pressed=None):
+        """
+        Queue a press of button; returns False if it was dropped as a duplicate.
+        pressed is the time.monotonic() of the press.
+        """
+        if pressed is None:
+            pressed = time.monotonic()
+        with self._lock:
+            last = self._last.get(button)
+            if last is not None and pressed - last < self.window:
+                self.duplicates += 1
+                return False
+            self._last[button] = pressed
+        self._commands.put((button, pressed))
+        self._timers.wake()
+        return True
+
+    def _run(self):
+        while not self._halt.is_set():
+            self._timers.wait()
+            try:
+                self._timers.run_due()
+                while not self._halt.is_set():
+                    try:
+                        command = self._commands.get_nowait()
+                    except queue.Empty:
+                        break
+                    self._pulse(*command)
+            except Exception as err:
+                self.report("Relay actuator error: " + str(err), 'ERROR')
+        self._release_all()
+
+    def _pulse(self, button, pressed):
+        if button in self._active:
+            self._waiting.setdefault(button, deque()).append(pressed)
+            return
+        pulse = self.handler(button, pressed)
+        if pulse is None:
+            return
+        pin, pol, hold = pulse
+        self._active[button] = (pin, pol, time.monotonic())
+        self._timers.schedule(time.time() + hold, ('off', button), self._off, button)
+        self.gpio.output(pin, self.gpio.HIGH ^ pol)
+        press_relay_seconds.observe(time.monotonic() - pressed)
+
+    def _off(self, button):
+        pin, pol, on = self._active[button]
+        self._timers.schedule(time.time() + self.gap, ('ready', button), self._ready, button)
+        self.gpio.output(pin, self.gpio.LOW ^ pol)
+        toggle_seconds.observe(time.monotonic() - on)
+
+    def _ready(self, button):
+        del self._active[button]
+        waiting = self._waiting.get(button)
+        if waiting:
+            self._pulse(button, waiting.popleft())
+
+    def _release_all(self):
+        for button, (pin, pol, on) in self._active.items():
+            try:
+                self.gpio.output(pin, self.gpio.LOW ^ pol)
+            except Exception:
+                pass
+        self._active.clear()
+
+    def stop(self, timeout=2):
+        """
+        Stop the worker and switch off any relay that is on. Presses still
+        queued are dropped.
+        """
+        self._halt.set()
+        self._timers.wake()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+
+###############################################################################
+# Sensor sampling
+#
+class SensorRing(object):
+    """
+    The last samples of one polled sensor pin, as bits of an int with the
+    newest in bit 0, and the level voted from them.
+    """
+    __slots__ = ('pin', 'bits', 'level', 'changes')
+
+    def __init__(self, pin, level, window):
+        self.pin = pin
+        self.level = level
+        self.changes = 0  # voted level changes
+        self.fill(window)
+
+    def fill(self, window):
+        self.bits = (1 << window) - 1 if self.level else 0
+
+    def ones(self):
+        return bin(self.bits).count('1')
+
+    def run(self, level, window):
+        """
+        Number of newest samples in a row that read level.
+        """
+        x = (self.bits ^ ((1 << window) - 1 if level else 0)) & ((1 << window) - 1)
+        return (x & -x).bit_length() - 1 if x else window
+
+
+class SensorSampler(object):
+    """
+    Polls sensor pins at rate samples per second, instead of edge events,
+    for sensors on long or noisy wiring. Each pin keeps its last window
+    samples in a SensorRing. A pin goes to 1 once more than 1/2 + hysteresis
+    of its samples are 1, and back to 0 once fewer than 1/2 - hysteresis
+    are, so the window is the debounce time. on_change(pin, level, ts) is
+    called from the sampler thread with the time.time() the new level began.
+    """
+    def __init__(self, gpio, on_change, rate=50, window=16, hysteresis=SAMPLE_HYSTERESIS):
+        self.gpio = gpio
+        self.on_change = on_change
+        self.hysteresis = hysteresis
+        self.overruns = 0  # sampling rounds that started late
+        self._rings = {}   # pin -> SensorRing
+        self._lock = Lock()
+        self._wake = Event()
+        self._halt = Event()
+        self._thread = None
+        self.configure(rate, window)
+
+    def configure(self, rate, window):
+        """
+        Set the sample rate and window; a new window starts out filled
+        with each pin's voted level.
+        """
+        with self._lock:
+            self.period = 1.0 / max(1, rate)
+            if window != getattr(self, 'window', None):
+                self.window = max(3, window)
+                for r in self._rings.values():
+                    r.fill(self.window)
+            self.high = int(self.window * (0.5 + self.hysteresis)) + 1
+            self.low = self.window - self.high
+
+    def add(self, pin):
+        """
+        Start sampling pin; the window starts out filled with its current level.
+        """
+        level = self.gpio.input(pin)
+        with self._lock:
+            self._rings[pin] = SensorRing(pin, level, self.window)
+        self._wake.set()
+        return level
+
+    def remove(self, pin):
+        with self._lock:
+            return self._rings.pop(pin, None) is not None
+
+    def level(self, pin):
+        """
+        The voted level of pin, or None if it is not sampled.
+        """
+        r = self._rings.get(pin)
+        return None if r is None else r.level
+
+    def history(self):
+        """
+        Per pin: voted level, the samples (oldest first), their count of 1s,
+        and how often the level changed.
+        """
+        with self._lock:
+            return dict((r.pin, {'level': r.level, 'ones': r.ones(), 'changes': r.changes,
+                                 'samples': format(r.bits, '0%db' % self.window)})
+                        for r in self._rings.values())
+
+    def start(self):
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name='garage-sampler')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def sample(self):
+        """
+        Take one sample of every pin, and report the pins whose level changed.
+        """
+        changed = []
+        with self._lock:
+            mask = (1 << self.window) - 1
+            for r in self._rings.values():
+                try:
+                    level = 1 if self.gpio.input(r.pin) else 0
+                except Exception:
+                    continue
+                r.bits = ((r.bits << 1) | level) & mask
+                ones = r.ones()
+                if (r.level == 0 and ones >= self.high) or (r.level == 1 and ones <= self.low):
+                    r.level ^= 1
+                    r.changes += 1
+                    changed.append((r.pin, r.level, time.time() - r.run(r.level, self.window) * self.period))
+        for pin, level, ts in changed:
+            self.on_change(pin, level, ts)
+
+    def _run(self):
+        due = time.monotonic()
+        while not self._halt.is_set():
+            if not self._rings:
+                self._wake.wait()
+                self._wake.clear()
+                due = time.monotonic()
+                continue
+            self.sample()
+            due += self.period
+            delay = due - time.monotonic()
+            if delay < 0:
+                self.overruns += 1
+                due = time.monotonic()
+            else:
+                self._halt.wait(delay)
+
+    def stop(self, timeout=2):
+        self._halt.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+
+###############################################################################
+# Door model
+#
+# Door state machine. Each door has one sensor, which is closed when the
+# door is down, so the sensor events are 'closed', 'open' and 'unknown'
+# (the sensor can't be read); 'press' is a relay press, and 'timeout' the
+# end of the travel time of a moving door. Events not in the table leave
+# the state as it is.
+#
+DOOR_STATES = ('UNKNOWN', 'CLOSED', 'OPENING', 'OPEN', 'CLOSING', 'STALLED')
+MOVING_STATES = ('OPENING', 'CLOSING')
+
+DOOR_TRANSITIONS = {
+    ('UNKNOWN', 'closed') : 'CLOSED',
+    ('UNKNOWN', 'open')   : 'OPEN',
+    ('CLOSED' , 'open')   : 'OPENING',  # the door left the sensor
+    ('CLOSED' , 'press')  : 'OPENING',
+    ('OPENING', 'closed') : 'CLOSED',   # reversed, or never moved
+    ('OPENING', 'press')  : 'CLOSING',
+    ('OPENING', 'timeout'): 'OPEN',     # no sensor at the top, so the travel time tells
+    ('OPEN'   , 'closed') : 'CLOSED',
+    ('OPEN'   , 'press')  : 'CLOSING',
+    ('CLOSING', 'closed') : 'CLOSED',
+    ('CLOSING', 'press')  : 'OPENING',
+    ('CLOSING', 'timeout'): 'STALLED',  # overdue, stuck part way
+    ('STALLED', 'closed') : 'CLOSED',
+    ('STALLED', 'press')  : 'CLOSING',
+}
+DOOR_TRANSITIONS.update(((state, 'unknown'), 'UNKNOWN') for state in DOOR_STATES[1:])
+SENSOR_EVENTS = {'CLOSED': 'closed', 'OPEN': 'open'}  # sensor reading -> event
+
+
+class Door(object):
+    """
+    Runtime state of one door (or other relay button), keyed by its number.
+    The relay and sensor settings of the door live in the settings snapshot.
+    travel holds the recent times the door took from a press to CLOSED,
+    from which it learns how long a move may take.
+    """
+    __slots__ = ('n', 'state', 'since', 'event_time', 'nag_limit', 'moved', 'travel')
+
+    def __init__(self, n):
+        self.n = n
+        self.state = "UNKNOWN"
+        self.since = None      # time the door entered its current state
+        self.event_time = 0    # last button press or sensor event of this door
+        self.nag_limit = 0     # OPEN nags left before we go quiet
+        self.moved = None      # time the door was pressed to close, until it is CLOSED
+        self.travel = []       # recent travel times, seconds
+
+    def next_state(self, event):
+        """
+        The state event leads to, or None if it does not change the state.
+        """
+        return DOOR_TRANSITIONS.get((self.state, event))
+
+    def learn_travel(self, seconds):
+        self.travel.append(round(seconds, 2))
+        del self.travel[:-TRAVEL_SAMPLES]
+
+    def travel_timeout(self):
+        """
+        Seconds a move may take before it is overdue: DOOR_MOVE_TIMEOUT until
+        TRAVEL_MIN_SAMPLES travel times have been seen, then their mean plus
+        TRAVEL_SIGMAS standard deviations and TRAVEL_SLACK.
+        """
+        t = self.travel
+        if len(t) < TRAVEL_MIN_SAMPLES:
+            return DOOR_MOVE_TIMEOUT
+        mean = sum(t) / len(t)
+        sd = (sum((x - mean) ** 2 for x in t) / (len(t) - 1)) ** 0.5
+        return mean + TRAVEL_SIGMAS * sd + TRAVEL_SLACK
+
+    def snapshot(self):
+        return {'state': self.state, 'since': self.since, 'event_time': self.event_time,
+                'nag_limit': self.nag_limit, 'moved': self.moved, 'travel': self.travel}
+
+
+def door_numbers(group):
+    """
+    Relay or sensor numbers of a settings group, in numeric order.
+    """
+    return sorted(group, key=lambda n: int(n) if n.isdigit() else 0)
+
+
 ###############################################################################
 # Garage controller thread
 #
 class GarageControl(Thread):
     def __init__(self, gpio):
         Thread.__init__(self)
-        # add plugin menu items:
-        gv.plugin_menu.append(gvmenu_settings)
-        gv.plugin_menu.append(gvmenu_button1)
-        gv.plugin_menu.append(gvmenu_button2)
+        self.menus = []
+        self.register_menus(get_data())
         # add urls:
         urls.extend(plugin_urls)
         # remaining plugin init:
         self.daemon = True
         self.name = 'garage'
         self.gpio = gpio
-        self.status = ''
+        self.status_log = StatusLog()
+        self._changes = 0  # bumped on every door state or nag change, see version
+        self.events = EventBroker()
+        self.history = EventHistory()
+        self.stats = UsageStats()
         self._sleep_time = 0
-        self._door_state = {"1":"UNKNOWN", "2":"UNKNOWN"}
-        self._event_time = 0  # events are buttons and door sensors
+        self.doors = {}         # door number -> Door
+        self._door_state = {}   # door number -> state, shared as gv.gc_door_state
+        self._sensor_pins = {}  # sensor pin -> door number
         self.settings = {}
         self.subject = "Garage"  # TODO add subject to settings file
-        self.notify_qtr = False
-        self.tp = 10  # seconds to pause thread loop
+        self._state_dirty = False  # a snapshot write is scheduled
+        self._settings_dirty = False  # a data file write is scheduled
+        self._state_saved = None   # last snapshot written
+        self._halt = Event()      # set to make the thread exit
+        self._released = Event()  # set once the thread has released GPIO and flushed its files
+        self._edge_thread = None
+        self.timers = DeadlineScheduler()
+        self._edges = queue.Queue()  # (pin, level, monotonic time) from the GPIO callback
+        self._config_lock = Lock()
+        self._door_lock = RLock()  # held by every change of door state or nag count
+        self.actuator = RelayActuator(gpio, self._press_button, lambda msg, level: self.add_status(msg, level=level))
+        self.sampler = SensorSampler(gpio, self.sensor_sample)
+        self.notifier = NotifyDispatcher(self.send_notification)
+        self.coalescer = NotifyCoalescer(self.queue_notification, self.timers)
+        self.outbox = Outbox(self.retry_notifications, lambda msg, level: self.add_status(msg, level=level))
+        self.notifier.start()
         self.start()
 
-    def clear_nag_limit(self):
+    def register_menus(self, s):
+        """
+        Plugin menu items: the settings page, and a button for each relay.
+        """
+        for m in self.menus:
+            if m in gv.plugin_menu:
+                gv.plugin_menu.remove(m)
+        self.menus = [gvmenu_settings] + [[u"Garage Button %s" % n, u"/garage-b%s" % n]
+                                          for n in door_numbers(s['relay'])]
+        gv.plugin_menu.extend(self.menus)
+
+    def door(self, n):
+        """
+        The Door for relay/sensor number n, created on first use.
+        """
+        d = self.doors.get(n)
+        if d is None:
+            d = self.doors[n] = Door(n)
+            self._door_state[n] = d.state
+        return d
+
+    def add_doors(self, s):
+        for n in list(s['relay']) + list(s['sensor']):
+            self.door(n)
+        self._sensor_pins = dict((s['sensor'][n]['pin'], n) for n in s['sensor'] if s['sensor'][n]['pin'])
+
+    def clear_nag_limit(self, n=None):
         """
         very complex method to clear nag limit for web interface button
         ;-)
+        Clears every door, or only door n.
         """
-        self.nag_limit = 0
-        gv.gc_nag = False
+        with self._door_lock:
+            for d in (self.doors.values() if n is None else [self.door(n)]):
+                d.nag_limit = 0
+            self.update_nag()
 
-    def set_nag_limit(self, limit=6):
+    def set_nag_limit(self, n, limit=6):
         """
-        very complex method to clear nag limit for web interface button
+        very complex method to set nag limit of door n
         ;-)
         """
-        self.nag_limit = limit
-        gv.gc_nag = True
+        with self._door_lock:
+            self.door(n).nag_limit = limit
+            self.update_nag()
+
+    def reset_nag_limit(self, n, state):
+        """
+        Reset the nag timer limit of door n for its new state.
+        """
+        if state == "CLOSED":
+            self.set_nag_limit(n, self.settings['ntfy_gdc'][2])
+        elif state == "OPEN" or state == "STALLED":
+            self.set_nag_limit(n, self.settings['ntfy_gdo'][2])
+
+    def update_nag(self):
+        """
+        gv.gc_nag tells the home page if any door is still nagging: open
+        (or stalled) with nags left. A closed door's nag_limit only counts
+        its closed reminders.
+        """
+        nag = any(d.nag_limit > 0 and d.state in ("OPEN", "STALLED") for d in self.doors.values())
+        if gv.gc_nag != nag:
+            gv.gc_nag = nag
+            self.events.publish('nag', {'nag': nag})
+        self._changes += 1
+        self.save_state_soon()
+
+    def set_door_state(self, n, state):
+        """
+        Every change of a door state goes through here.
+        """
+        now = time.time()
+        d = self.door(n)
+        if d.state != state:
+            d.since = now
+            self.stats.state(n, d.state, state, now)
+        d.state = self._door_state[n] = state
+        self._changes += 1
+        self.events.publish('door', {'door': n, 'state': state, 'ts': now})
+        self.record_history(n, 'state', state, now)
+        self.update_nag()
+
+    def door_input(self, n, event, event_time=None):
+        """
+        Feed an event to the state machine of door n, and act on the
+        transition. Returns the new state, or None if it did not change.
+        """
+        with self._door_lock:
+            d = self.door(n)
+            if event_time is not None:
+                d.event_time = event_time
+            old = d.state
+            new = d.next_state(event)
+            if new is None:
+                return None
+            if new == 'CLOSED' and d.moved is not None and TRAVEL_MIN <= d.event_time - d.moved <= DOOR_MOVE_TIMEOUT:
+                d.learn_travel(d.event_time - d.moved)
+            if new == 'CLOSING':
+                d.moved = d.event_time
+            elif new != 'STALLED':
+                d.moved = None
+            self.set_door_state(n, new)
+            self.reset_nag_limit(n, new)
+        self.add_status("Door %s is %s" % (n, new), door=n)
+        if new == 'STALLED':
+            self.try_notify(self.subject, "Garage Door {} is taking a long time to close ({:.0f}s). It may be stuck part way open.".format(n, d.travel_timeout()), door=n)
+        elif old != 'UNKNOWN' and self.settings['ntfy_gev'] == 'on':
+            self.try_notify(self.subject, "\nDoor %s %s" % (n, new), door=n)
+        return new
+
+    def record_history(self, n, kind, state, ts):
+        if self.history.record(n, kind, state, ts):
+            self.timers.schedule(time.time(), 'history', self.history_flush)
+
+    def save_stats(self):
+        try:
+            self.stats.flush()
+        except Exception as err:
+            self.add_status('Error writing usage statistics: ' + str(err), level='ERROR')
+
+    def stats_flush(self):
+        self.save_stats()
+        self.timers.schedule(time.time() + STATS_FLUSH, 'stats', self.stats_flush)
+
+    def history_flush(self):
+        try:
+            self.history.flush()
+        except Exception as err:
+            self.add_status('Error writing door history: ' + str(err), level='ERROR')
+        self.timers.schedule(time.time() + HISTORY_FLUSH, 'history', self.history_flush)
+
+    @property
+    def version(self):
+        """
+        Changes whenever door state, nag state or the status log changes.
+        Used as the ETag of the status API.
+        """
+        return self._changes + self.status_log.seq
+
+    def api_status(self, events=API_EVENTS):
+        """
+        Current door states, nag status and recent events, for the JSON API.
+        """
+        with self._door_lock:
+            status = {
+                'doors'    : dict(self._door_state),
+                'nag'      : gv.gc_nag,
+                'nag_limit': dict((n, d.nag_limit) for n, d in self.doors.items()),
+                'travel'   : dict((n, round(d.travel_timeout(), 1)) for n, d in self.doors.items() if d.travel),
+            }
+        status['events'] = [rec._asdict() for rec in self.status_log.last(events)] if events else []
+        return status
 
     def quarter_time(self):
         """
@@ -137,137 +1944,300 @@ class GarageControl(Thread):
         return qt + timedelta(seconds = delta)
 
 
-    # TODO FIXME : It would be nice to replace this status string with a logging mechanism,
-    #              so we get it outta memory if in append, aka debug, mode.
-    def add_status(self, msg, debug=True):
-        _status = 'STATUS: ' + time.strftime("%d.%m.%Y at %H:%M:%S", time.localtime(time.time())) + ': ' + msg
-        if self.status and debug:
-            self.status += '\n' + _status
-        else:
-            self.status = _status
+    @property
+    def status(self):
+        """
+        The most recent status records, as text.
+        """
+        return self.status_log.text()
+
+    def add_status(self, msg, debug=True, level='INFO', door=None):
+        rec = self.status_log.add(msg, level, door)
         if debug:
-            print(_status)
+            print(self.status_log.format(rec))
 
-    def try_notify(self, subject, text, when=None, attachment=None):
+    def try_notify(self, subject, text, when=None, attachment=None, door=None, low=False):
         """
         This method will send a notification if enabled in settings.
         By default, the notifications are disabled until enabled in
         settings.
-        Here we have support for email notification and Twilio SMS.
-        Note: with email notifcation, you can generally send SMS via
-        a cell provider's SMS gateway.
+        The notification is only queued here; it is sent by the
+        notification workers, so this never blocks on the network.
+        It passes the coalescer first, which can merge notifications about
+        the same door, drop duplicates, and hold low priority reminders
+        for the digest.
         """
-        #self.status = ''
-        mail_en = False if self.settings['mail_en'] == 'off' else True
-        twil_en = False if self.settings['twil_en'] == 'off' else True
         if when is None:
             when = time.localtime(time.time())
         _time = time.strftime("%d.%m.%Y at %H:%M:%S", when)
-        text = text + "\nOn " + _time
-        if mail_en:
-            try:
-                #send_email_insec(subject, text, attachment)  # send email with attachment from
-                send_email_insec(subject, text)  # send email with attachment from
-                self.add_status('Email sent: ' + text)
-            except Exception as err:
-                self.add_status('Email not sent! ' + str(err))
-        if twil_en:
+        s = self.settings
+        self.coalescer.add(subject, text, _time, door, low, window=s['ntfy_win'],
+                           digest=s['ntfy_dig'][1] if s['ntfy_dig'][0] == 'on' else 0)
+
+    def queue_notification(self, subject, text, queued):
+        if not self.notifier.submit(subject, text, queued):
+            notifications_dropped.inc()
+            self.add_status('Notification queue full, dropped: ' + text, level='ERROR')
+
+    def send_notification(self, subject, text, queued=None):
+        """
+        Runs in a notification worker thread.
+        Each channel enabled in settings is sent by its backend in
+        NOTIFIERS: email, Twilio SMS, a webhook, a local file or syslog.
+        Note: with email notifcation, you can generally send SMS via
+        a cell provider's SMS gateway.
+        A notification that fails goes to the outbox to be retried; while a
+        channel has messages in the outbox, new ones queue up behind them.
+        """
+        created = self.created(queued)
+        for channel in self.channels():
+            if self.outbox.pending(channel):
+                self.outbox.add(channel, subject, text, created)
+                continue
             try:
-                send_sms(self.settings['twil_sid'], self.settings['twil_atok'], self.settings['twil_to'], self.settings['twil_from'], text)
-                self.add_status('SMS sent: ' + text)
+                self.deliver(channel, subject, text)
             except Exception as err:
-                self.add_status('SMS not sent! ' + str(err))
+                notifications.inc(channel, 'failed')
+                self.add_status('%s not sent, will retry! %s' % (channel_title(channel), err), level='ERROR')
+                self.events.publish('notify', {'channel': channel, 'ok': False, 'error': str(err)})
+                self.outbox.add(channel, subject, text, created, attempts=1, error=str(err))
+                continue
+            notifications.inc(channel, 'sent')
+            if queued is not None:
+                notify_seconds.observe(time.monotonic() - queued)
+            self.add_status('%s sent: %s' % (channel_title(channel), text))
+            self.events.publish('notify', {'channel': channel, 'ok': True, 'text': text})
+
+    def spool_notification(self, subject, text, queued=None):
+        """
+        Put a notification that was never sent in the outbox of every
+        enabled channel, to be sent from there.
+        """
+        for channel in self.channels():
+            self.outbox.add(channel, subject, text, self.created(queued))
+
+    def created(self, queued):
+        """
+        The time.time() of a notification queued at time.monotonic() queued.
+        """
+        return time.time() - (time.monotonic() - queued) if queued is not None else None
+
+    def retry_notifications(self, channel, messages):
+        """
+        Runs in the outbox thread. Sends (subject, text, attempts) messages
+        as one batch; returns how many were sent, and the error that
+        stopped the batch or None.
+        """
+        if channel not in self.channels():
+            for subject, text, attempts in messages:
+                self.add_status('%s disabled, dropped: %s' % (channel_title(channel), text))
+            return len(messages), None
+        sent, err = get_notifier(channel).send_batch(self.settings, [m[:2] for m in messages])
+        for subject, text, attempts in messages[:sent]:
+            notifications.inc(channel, 'sent')
+            self.add_status('%s sent from outbox (%d failed attempts): %s' % (channel_title(channel), attempts, text))
+            self.events.publish('notify', {'channel': channel, 'ok': True, 'text': text})
+        return sent, err
+
+    def channels(self):
+        """
+        The notification channels enabled in settings, in NOTIFIERS order.
+        """
+        s = self.settings
+        return [c for c, backend in NOTIFIERS.items() if s.get(backend.enable, 'off') != 'off']
+
+    def deliver(self, channel, subject, text):
+        """
+        Send a notification on one channel; raises if it could not be sent.
+        """
+        get_notifier(channel).send(self.settings, subject, text)
 
     def setup_gpio(self, s):
         """
         Sets up GPIO pins for relays and sensors as set in garage settings.
-        Supports 'n' relays and sensors, however, the HTML in templates/garage.html
-        is only coded for up to 2 relays and sensors (the HTML could be improved.)
-        """
-        r = s['relay']
-        for n in r:
-            pin = r[n]['pin']  # relay GPIO pin
-            pol = r[n]['pol']  # relay GPIO polarity
-            prm = r[n]['prm']  # relay permit open
-            typ = r[n]['typ']  # relay type: '1' is a door, '0' is other
-            if pin:
-                try:
-                    self.gpio.setup(pin, self.gpio.OUT)
-                    self.gpio.output(pin, self.gpio.LOW ^ pol)
-                    self.add_status("Adding Relay %s: output-pin(%0d); polarity(%0d); permit-open(%r); is-a-door(%r)" % (n, pin, pol, prm, typ))
-                except:
-                    self.add_status("Error setting GPIO for Relay %s" % n)
-        s = s['sensor']
-        for n in s:
-            pin = s[n]['pin']  # sensor GPIO pin
-            pud = s[n]['pud']  # sensor GPIO pull-up(1) or pull-down(0) enable
-            if pin:
-                try:
-                    gpud = self.gpio.PUD_UP if pud else self.gpio.PUD_DOWN 
-                    self.add_status("Enabling input sensor %s on gpio pin: %0d; PUD(%0d)" % (n, pin, pud))
-                    self.gpio.setup(pin, self.gpio.IN, pull_up_down=gpud)
-                    self._door_state[n] = self.get_door_state(pin)  # get initial state of door sensor
-                    self.add_status("Initial door %s sensor state is %s" % (n, self._door_state[n]))
+        Supports 'n' relays and sensors; relay n and sensor n belong to door n.
+        """
+        for n in s['relay']:
+            self.setup_relay(n, s['relay'][n])
+        for n in s['sensor']:
+            self.setup_sensor(n, s['sensor'][n])
+
+    def setup_relay(self, n, r):
+        pin = r['pin']  # relay GPIO pin
+        pol = r['pol']  # relay GPIO polarity
+        prm = r['prm']  # relay permit open
+        typ = r['typ']  # relay type: '1' is a door, '0' is other
+        if pin:
+            try:
+                self.gpio.setup(pin, self.gpio.OUT)
+                self.gpio.output(pin, self.gpio.LOW ^ pol)
+                self.add_status("Adding Relay %s: output-pin(%0d); polarity(%0d); permit-open(%r); is-a-door(%r)" % (n, pin, pol, prm, typ))
+            except:
+                self.add_status("Error setting GPIO for Relay %s" % n, level='ERROR')
+
+    def setup_sensor(self, n, s):
+        pin = s['pin']  # sensor GPIO pin
+        pud = s['pud']  # sensor GPIO pull-up(1) or pull-down(0) enable
+        if pin:
+            try:
+                gpud = self.gpio.PUD_UP if pud else self.gpio.PUD_DOWN 
+                self.add_status("Enabling input sensor %s on gpio pin: %0d; PUD(%0d)" % (n, pin, pud))
+                self.gpio.setup(pin, self.gpio.IN, pull_up_down=gpud)
+                if self.settings['sens_poll'] == 'on':
+                    self.sampler.add(pin)
+                state = self.get_door_state(pin)  # get initial state of door sensor
+                self.door_input(n, SENSOR_EVENTS.get(state, 'unknown'))
+                self.add_status("Initial door %s sensor state is %s" % (n, state), door=n)
+                if self.settings['sens_poll'] == 'on':
+                    self.add_status("Polling door %s sensor at %d Hz" % (n, self.settings['sens_rate']))
+                else:
                     self.add_status("Adding door %s sensor event detection" % n)
-                    self.gpio.add_event_detect(pin, self.gpio.BOTH, callback=self.door_event, bouncetime=1000)
-                except:
-                    self.add_status("Error setting GPIO for Sensor %s" % n)
-       
-        
-    
+                    self.gpio.add_event_detect(pin, self.gpio.BOTH, callback=self.door_event, bouncetime=SENSOR_BOUNCETIME)
+            except:
+                self.add_status("Error setting GPIO for Sensor %s" % n, level='ERROR', door=n)
+
+    def apply_settings(self, settings):
+        """
+        Apply a new settings snapshot while the monitor loop keeps running.
+        Only relays and sensors whose GPIO configuration changed are set up
+        again; notification and timing settings take effect with the swap,
+        and the timers are re-armed with the new intervals.
+        """
+        with self._config_lock:
+            old = self.settings
+            if not old:  # not started yet, run() picks the settings up
+                self.settings = settings
+                return
+            relays = [n for n in settings['relay'] if old['relay'].get(n) != settings['relay'][n]]
+            sensors = [n for n in set(old['sensor']) | set(settings['sensor'])
+                       if old['sensor'].get(n) != settings['sensor'].get(n) or old['sens_poll'] != settings['sens_poll']]
+            for n in sensors:
+                if n in old['sensor'] and old['sensor'][n]['pin']:
+                    self.remove_sensor(old['sensor'][n]['pin'])
+            self.sampler.configure(settings['sens_rate'], settings['sens_win'])
+            self.settings = settings  # pin to door lookups and timers now use the new settings
+            self.add_doors(settings)
+            if set(old['relay']) != set(settings['relay']):
+                self.register_menus(settings)
+            for n in relays:
+                self.setup_relay(n, settings['relay'][n])
+            for n in sensors:
+                if n in settings['sensor'] and settings['sensor'][n]['pin']:
+                    self.setup_sensor(n, settings['sensor'][n])
+                else:
+                    self.door_input(n, 'unknown')
+            self.actuator.window = settings['rly_dup'] / 1000.0
+            if old['log_file'] != settings['log_file']:
+                self.status_log.set_file(STATUS_LOG_FILE if settings['log_file'] == 'on' else None)
+            self.add_status("Settings applied; reconfigured relays %s, sensors %s" % (sorted(relays), sorted(sensors)))
+            self.schedule_all()
+
+    def remove_sensor(self, pin):
+        """
+        Stop edge detection or polling of a sensor pin.
+        """
+        if not self.sampler.remove(pin):
+            try:
+                self.gpio.remove_event_detect(pin)
+            except Exception:
+                pass
+
     def get_door_state(self, pin):
+        """
+        The door state from one reading of a sensor, or from the voted level
+        if it is polled.
+        """
         try:
-            if self.gpio.input(pin) == 0:
-                self.set_nag_limit(self.settings['ntfy_gdc'][2])  # reset nag timer limit
-                state = "CLOSED"
             # TODO : System Improvement:
             #        If the pin state is '1', we say it's OPEN, but it could be OPENING or CLOSING
             #        To improve, I could add a second sensor to indicate when the door is fully open.
-            if self.gpio.input(pin) == 1:
-                self.set_nag_limit(self.settings['ntfy_gdo'][2])  # reset nag timer limit
-                state = "OPEN"
+            level = self.sampler.level(pin)
+            if level is None:
+                level = self.gpio.input(pin)
+            state = "CLOSED" if level == 0 else "OPEN"
         except Exception as err:
             print('Error: get_door_state: ' + str(err))
             state = "ERROR"
         return(state)
     
-    def door_event(self,channel):
+    def door_event(self, channel, level=None, ts=None):
         """
         This is the GPIO event callback function. It runs in a separate thread,
-        and is called anytime the configured sensor changes status. When called,
-        it changes the door status so we can act on it.
+        and is called anytime the configured sensor changes status. It only
+        queues the edge, so no sensor ever waits on another one's debounce;
+        the edge thread settles it and changes the door status.
+        RPi.GPIO only passes the channel; pigpio also passes the level and
+        the time.monotonic() of the edge, from its hardware timestamp.
         """
-        self._event_time = time.time()
-        time.sleep(0.250)
-        _door_state = self.get_door_state(channel)
-        self.add_status("Door sensor triggered on channel %0d" % channel)
-        self.add_status("DEBUG: Door on channel %s is %s" % (channel, _door_state))
-        s = self.settings['sensor']
-        for n in s:
-            pin = s[n]['pin']
-            pud = s[n]['pud']
-            if(channel == pin):
-                #time.sleep(0.250)
-                time.sleep(1)
-                _door_state = self.get_door_state(channel)
-                if not (self._door_state[n] == _door_state):
-                    self._door_state[n] = _door_state
-                    #self._door_state[n] = self.get_door_state(channel)
-                    self.add_status("Door %s is %s" % (n, self._door_state[n]))
-                    if self.settings['ntfy_gev'] == 'on':
-                        self.try_notify(self.subject, "\nDoor %s %s" % (n, self._door_state[n]))
+        sensor_edges.inc()
+        if level is None:
+            try:
+                level = self.gpio.input(channel)
+            except Exception:
+                level = None
+        self._edges.put((channel, level, time.monotonic() if ts is None else ts))
+
+    def sensor_sample(self, pin, level, ts):
+        """
+        Sampler callback: the voted level of a polled sensor changed at ts.
+        The sample window has done the debouncing, so the door state is
+        taken at once.
+        """
+        sensor_edges.inc()
+        self.add_status("Door sensor on channel %0d changed to level %s" % (pin, level))
+        try:
+            self.settle_door(pin, ts)
+        except Exception as err:
+            self.add_status("Error handling door event on channel %s: %s" % (pin, err), level='ERROR')
+
+    def edge_loop(self):
+        """
+        Edge consumer thread. Each sensor pin has its own settle deadline,
+        pushed back by every edge on that pin. Once a pin has been quiet for
+        the settle time (sens_stl), its door state is taken.
+        """
+        pending = {}  # pin -> [settle deadline, time of first edge]
+        while True:
+            timeout = None
+            if pending:
+                timeout = max(0, min(p[0] for p in pending.values()) - time.monotonic())
+            try:
+                edge = self._edges.get(timeout=timeout)
+                if edge is None:
+                    return
+                pin, level, ts = edge
+                settle = self.settings['sens_stl'] / 1000.0
+                if pin in pending:
+                    pending[pin][0] = ts + settle
                 else:
-                    self.add_status("DEBUG: Door status unchanged, Door %s is %s" % (n, self._door_state[n]))
-                break
-# TODO : Need to figure out a way to reload status when door closes, for home page buttons
-#        if _door_state == "CLOSED":
-#            raise web.seeother(u"/")  # return to home page
-    
-    def toggle_relay(self, pin, pol, hold_time):
-        self.gpio.output(pin, self.gpio.HIGH ^ pol)
-        time.sleep(hold_time)
-        self.gpio.output(pin, self.gpio.LOW ^ pol)
+                    pending[pin] = [ts + settle, ts]
+                    self.add_status("Door sensor triggered on channel %0d, level %s" % (pin, level))
+            except queue.Empty:
+                pass
+            now = time.monotonic()
+            for pin in [p for p in pending if pending[p][0] <= now]:
+                first = pending.pop(pin)[1]
+                try:
+                    self.settle_door(pin, time.time() - (now - first))
+                    edge_seconds.observe(time.monotonic() - first)
+                except Exception as err:
+                    self.add_status("Error handling door event on channel %s: %s" % (pin, err), level='ERROR')
 
+    def settle_door(self, channel, event_time):
+        """
+        Take the state of a sensor that has stopped bouncing, and act on
+        a change of door status.
+        """
+        _door_state = self.get_door_state(channel)
+        self.add_status("DEBUG: Door on channel %s is %s" % (channel, _door_state), level='DEBUG')
+        n = self._sensor_pins.get(channel)
+        if n is None:
+            return
+        with self._door_lock:
+            if self.door_input(n, SENSOR_EVENTS.get(_door_state, 'unknown'), event_time) is None:
+                self.add_status("DEBUG: Door status unchanged, Door %s is %s" % (n, self.door(n).state), level='DEBUG', door=n)
+            self.schedule_door(n)
+    
     def press_button(self, button):
         """
         'Presses' the button using the configured relay. Relay could be a door,
@@ -275,156 +2245,354 @@ class GarageControl(Thread):
         Note: pressing button does not check the physical value of the sensor,
               because the sensor is checked by the GPIO event thread. This method
               checks the door state value, which is set by the door event.
+        The press is queued for the relay actuator, so this returns at once.
+        Returns False if it was dropped as a repeat of a press within the
+        rly_dup window.
+        """
+        with press_seconds.time():
+            if self.actuator.press(button, time.monotonic()):
+                return True
+        self.add_status("Repeated press of relay %s ignored" % button, door=button)
+        return False
+
+    def _press_button(self, button, pressed):
         """
+        Runs in the relay actuator thread: decide what the press does, and
+        return the relay pulse (pin, polarity, hold time), or None.
+        """
+        pulse = None
         try:
-            _rp = self.settings['relay'][button]['pin']
-            _rx = self.settings['relay'][button]['pol']
-            _po = self.settings['relay'][button]['prm']
-            _rd = self.settings['relay'][button]['typ']
-            _dy = 0.2  # relay toggle delay
-            if not _rd:  # if not a door, allow toggle anytime
-                self.toggle_relay(_rp,_rx,_dy)
-                self._door_state[button] = 'NOT_A_DOOR'
-                self.add_status("Toggled Relay %s" % button)
-            else:  # otherwise, relay is a door, so honor allow-open permission
-                if not _po and (self._door_state[button] == 'CLOSED' or self._door_state[button] == 'CLOSING'):
-                    self.add_status("Opening Door %s not permitted." % button)
-                elif self._door_state[button] == 'OPEN' or self._door_state[button] == 'OPENING':
-                    self.toggle_relay(_rp,_rx,_dy)
-                    self._door_state[button] = 'CLOSING'
-                    self.add_status("Closing Door %s" % button)
-                elif self._door_state[button] == 'CLOSED' or self._door_state[button] == 'CLOSING':
-                    self.toggle_relay(_rp,_rx,_dy)
-                    # TODO: If we have a sensor to check for open door, set state to OPENING, else set to OPEN.
-                    #self._door_state[button] = 'OPENING'
-                    self._door_state[button] = 'OPEN'
-                    self.add_status("Opening Door %s" % button)
-                else:
-                    self.add_status("Door %s state is unknown..." % button)
-            self._event_time = time.time()
+            with self._door_lock:
+                d = self.door(button)
+                _rp = self.settings['relay'][button]['pin']
+                _rx = self.settings['relay'][button]['pol']
+                _po = self.settings['relay'][button]['prm']
+                _rd = self.settings['relay'][button]['typ']
+                if not _rd:  # if not a door, allow toggle anytime
+                    pulse = (_rp, _rx, RELAY_HOLD)
+                    self.set_door_state(button, 'NOT_A_DOOR')
+                    self.add_status("Toggled Relay %s" % button)
+                else:  # otherwise, relay is a door, so honor allow-open permission
+                    new = d.next_state('press')
+                    if not _po and new == 'OPENING':
+                        self.add_status("Opening Door %s not permitted." % button, door=button)
+                    elif new is None:
+                        self.add_status("Door %s state is unknown..." % button, door=button)
+                    else:
+                        pulse = (_rp, _rx, RELAY_HOLD)
+                        self.add_status("%s Door %s" % ("Closing" if new == 'CLOSING' else "Opening", button), door=button)
+                        self.door_input(button, 'press', time.time())
+                d.event_time = time.time()
+                self.stats.press(button, d.event_time)
+                self.events.publish('press', {'door': button, 'state': d.state, 'ts': d.event_time})
+                self.record_history(button, 'press', d.state, d.event_time)
+                self.schedule_door(button)
         except:
-            self.add_status("Error toggling relay %s" % button)
+            self.add_status("Error toggling relay %s" % button, level='ERROR')
+        return pulse
 
-    def run(self):
-        t_start = gv.gc_start     # Keep thread start time (used in case thread restarts)
-        time.sleep(self.tp + 10)  # Sleep some time to prevent printing before startup information.
-                                  # This time delay should match, or exceed this loop sleep time so
-                                  # that a program restart does not create multiple gpio event threads.
-        self.add_status('Garage plugin starting...')
-        self.settings = get_data()
-        self.setup_gpio(self.settings)
+    def schedule_doors(self):
+        """
+        (Re)arm the per-door timers for each door's current state, so the
+        monitor loop sleeps until the next real deadline.
+        Called when the settings change.
+        """
+        for n in self.settings['sensor']:
+            self.schedule_door(n)
 
-        s = self.settings['sensor']
+    def schedule_door(self, n):
+        """
+        (Re)arm the timers of door n. Called whenever its state or event time changes.
+        """
+        s = self.settings
+        for kind in ('moving', 'nag', 'closed'):
+            self.timers.cancel((kind, n))
+        if n in s['sensor'] and s['sensor'][n]['pin']:
+            d = self.door(n)
+            if d.state in MOVING_STATES:
+                self.timers.schedule(d.event_time + d.travel_timeout() + s['sens_stl'] / 1000.0, ('moving', n),
+                                     self.door_move_timeout, n)
+            elif d.state == "OPEN" or d.state == "STALLED":
+                if s['ntfy_gdo'][0] == 'on' and s['ntfy_gdo'][1] and d.nag_limit > 0:
+                    self.timers.schedule(d.event_time + s['ntfy_gdo'][1], ('nag', n),
+                                         self.door_open_nag, n)
+            elif d.state == "CLOSED":
+                self.set_nag_limit(n, s['ntfy_gdo'][2])  # reset nag timer limit
+                if s['ntfy_gdc'][0] == 'on' and s['ntfy_gdc'][1]:
+                    self.timers.schedule(d.event_time + s['ntfy_gdc'][1], ('closed', n),
+                                         self.door_closed_reminder, n)
+        self.save_state_soon()
+
+    def write_settings_soon(self):
+        """
+        Schedule a write of the data file; saves within SETTINGS_SAVE_DELAY share one write.
+        """
+        if not self._settings_dirty:
+            self._settings_dirty = True
+            self.timers.schedule(time.time() + SETTINGS_SAVE_DELAY, 'settings', self.write_settings)
 
-        gv.gc_started = True
+    def write_settings(self):
+        """
+        Write the data file, if the settings changed since it was last written.
+        """
+        self._settings_dirty = False
+        try:
+            settings_cache.flush()
+        except Exception as err:
+            self.add_status('Error saving settings: ' + str(err), level='ERROR')
 
-        while True:
-            try:
-                gv.gc_door_state = self._door_state
-
-                # Monitor door state and notify.
-                for n in s:
-                    pin = s[n]['pin']  # sensor pin
-                    if(pin):
-                        if self._door_state[n] == "CLOSING" or self._door_state[n] == "OPENING":
-                            active_time = time.time()
-                            self.add_status("Detected door {} is {} at {}.".format(n, self._door_state[n], active_time) )
-                            # notify if "door active event" takes too long...
-                            while(self._door_state[n] == "CLOSING" or self._door_state[n] == "OPENING"):
-                                active_time = time.time()
-                                self.add_status("Detected door {} is still {} at {}.".format(n, self._door_state[n], active_time) )
-                                if active_time - self._event_time > 60:  # if closing or opening is taking too long, assume door is OPEN
-                                    self.try_notify(self.subject, "Garage Door {} is taking a long time to move. Assuming it's still OPEN.".format(n) )
-                                    self._event_time = time.time()
-                                    self.set_nag_limit(self.settings['ntfy_gdo'][2])  # reset nag timer limit
-                                    self._door_state[n] = "OPEN"
-                                time.sleep(1)
-
-                        if self._door_state[n] == "OPEN":
-                            """ Once door is OPEN, notify every top and quarter of the hour the door remains open, if set to do so in config settings.
-                                Also notify every time the timer reaches the config settings nag time value, and until we've nagged the number
-                                of times, also specified in config settings. This nag can be set to zero in settings.
-                            """
-                            next_qtr = self.quarter_time()  # get next quarter time
-                            # next quarter of the hour, _qh = (0: top; 1: first, or 15 after; 2: second, or 30 after; 3: third or 45 after)
-                            _qh = int(math.floor(next_qtr.minute/15))
-                            _ts = (next_qtr - datetime.today()).total_seconds()
-                            self.notify_qtr = False
-                            if _ts < self.tp:
-                                if self.settings['ntfy_gdq'][_qh] == 'on':
-                                    self.notify_qtr = True
-                            if self.notify_qtr:  # Notify if door is open at a quarter of the hour, as enabled in config
-                                self.try_notify(self.subject, "Friendly reminder that garage door {} is still OPEN.".format(n))
-                                self.notify_qtr = False
-                            if self.settings['ntfy_gdo'][0] == 'on' and self.settings['ntfy_gdo'][1]:
-                                open_time = time.time()
-                                if (open_time - self._event_time > self.settings['ntfy_gdo'][1]) and self.nag_limit > 0:
-                                    self._event_time = open_time
-                                    if self.nag_limit > 1:
-                                        self.try_notify(self.subject, "Garage Door {} is still Open ({})".format(n,self.nag_limit))
-                                    else:
-                                        self.try_notify(self.subject, "OK. I'll stop nagging, but Garage Door {} is still Open".format(n,self.nag_limit))
-                                    if self.nag_limit > 0:
-                                        self.nag_limit -= 1
-
-                        if self._door_state[n] == "CLOSED":
-                            self.set_nag_limit(self.settings['ntfy_gdo'][2])  # reset nag timer limit
-                            if self.settings['ntfy_gdc'][0] == 'on' and self.settings['ntfy_gdc'][1]:
-                                close_time = time.time()
-                                if close_time - self._event_time > self.settings['ntfy_gdc'][1]:
-                                    self._event_time = close_time
-                                    self.try_notify(self.subject, "Garage Door %s is still Closed" % n)
-#
-# TODO FIXME : * maybe add an option to close door after being open for a specified time
-#
-            except Exception:
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                err_string = ''.join(traceback.format_exception(exc_type, exc_value, exc_traceback))
-                self.add_status('Garage Control plugin encountered error:\n' + err_string)
-                time.sleep(3600)
-
-            #
-            # TODO FIXME : not sure why this happens, but occationally, the plugin is re-loaded/re-started
-            #              by the main SIP plugin code (I think) and so I added this code to keep track of
-            #              the thread start time, so the old thread is killed. Hack? Bug? Help...
-            #
-            #              If you know WHY this is happening, please enlighten me via github comments or message. TIA.
-            #
-            if not t_start == gv.gc_start:  # Program restarted, so clean-up GPIO and stop thread
-                for n in s:
-                    pin = s[n]['pin']
-                    if pin:
-                        self.gpio.remove_event_detect(pin)
-                print(time.strftime("%c") + ", Exiting Thread\n") 
-                self.add_status(time.strftime("%c") + ", Exiting Thread\n") 
-                # remove menu items/urls if we restart, so we don't keep expanding the lists!
-                gv.plugin_menu.remove(gvmenu_settings)
-                gv.plugin_menu.remove(gvmenu_button1)
-                gv.plugin_menu.remove(gvmenu_button2)
-                for v in plugin_urls:
-                    if v in urls:
-                        urls.remove(v)
-                return
-            # pause thread loop for 'n' seconds
-            time.sleep(self.tp)
+    def save_state_soon(self):
+        """
+        Schedule a snapshot write; changes within STATE_SAVE_DELAY share one write.
+        """
+        if not self._state_dirty:
+            self._state_dirty = True
+            self.timers.schedule(time.time() + STATE_SAVE_DELAY, 'state', self.save_state)
+
+    def save_state(self):
+        """
+        Write the warm-restart snapshot, unless nothing changed since the last write.
+        """
+        self._state_dirty = False
+        with self._door_lock:
+            data = json.dumps({
+                'doors': dict((n, d.snapshot()) for n, d in self.doors.items()),
+            }, sort_keys=True)
+        if data == self._state_saved:
+            return
+        try:
+            atomic_write(STATE_FILE, data)
+            self._state_saved = data
+        except Exception as err:
+            self.add_status('Error saving door state: ' + str(err), level='ERROR')
 
+    def restore_state(self):
+        """
+        Resume from the warm-restart snapshot after setup_gpio has read each
+        sensor once. A door that still reads its saved state (or, if it was
+        moving or STALLED, still reads open) carries on with that state, its
+        event time and nag count; a door that changed while we were stopped
+        is handled as a new event. Learned travel times are kept either way.
+        """
+        try:
+            with open(STATE_FILE, 'r') as fh:
+                snap = json.load(fh)
+        except (IOError, ValueError):
+            return
+        s = self.settings['sensor']
+        saved = snap.get('doors', {})
+        with self._door_lock:
+            resumed = []
+            for n in s:
+                if not s[n]['pin'] or n not in saved:
+                    continue
+                d = self.door(n)
+                d.travel = saved[n].get('travel', [])[-TRAVEL_SAMPLES:]
+                if saved[n]['state'] != d.state and d.state == "OPEN" and saved[n]['state'] in OPEN_STATES:
+                    self.set_door_state(n, saved[n]['state'])
+                    d.moved = saved[n].get('moved')
+                if saved[n]['state'] == d.state:
+                    d.since = saved[n]['since']
+                    d.event_time = saved[n]['event_time']
+                    self.set_nag_limit(n, max(0, saved[n]['nag_limit']))
+                    resumed.append(n)
+                else:
+                    d.event_time = time.time()
+                    self.add_status("Door %s changed to %s while stopped" % (n, d.state), door=n)
+                    if self.settings['ntfy_gev'] == 'on':
+                        self.try_notify(self.subject, "\nDoor %s %s" % (n, d.state), door=n)
+        if resumed:
+            self.add_status("Resumed state and nag count of doors %s from last run" % resumed)
+        self._state_saved = None
 
+    def schedule_quarter(self):
+        """
+        Arm the timer for the next top or quarter of the hour.
+        """
+        next_qtr = self.quarter_time()
+        # next quarter of the hour, _qh = (0: top; 1: first, or 15 after; 2: second, or 30 after; 3: third or 45 after)
+        _qh = next_qtr.minute // 15
+        self.timers.schedule(next_qtr.timestamp(), 'quarter', self.quarter_reminder, _qh)
+
+    def schedule_all(self):
+        self.schedule_quarter()
+        self.schedule_doors()
+        self.timers.schedule(time.time() + SMTP_IDLE_TIMEOUT, 'smtp', self.smtp_expire)
+        self.timers.schedule(time.time() + HISTORY_FLUSH, 'history', self.history_flush)
+        self.timers.schedule(time.time() + STATS_FLUSH, 'stats', self.stats_flush)
+
+    def door_move_timeout(self, n):
+        """
+        The travel time of a moving door is up. An OPENING door is now OPEN,
+        unless it never left the sensor; a CLOSING door that has not reached
+        the sensor is STALLED.
+        """
+        with self._door_lock:
+            d = self.door(n)
+            if d.state in MOVING_STATES:
+                if self.get_door_state(self.settings['sensor'][n]['pin']) == "CLOSED":
+                    if d.state == "OPENING":
+                        self.add_status("Door %s did not move" % n, door=n)
+                    self.door_input(n, 'closed', time.time())
+                else:
+                    self.door_input(n, 'timeout', time.time())
+            self.schedule_door(n)
 
+    def door_open_nag(self, n):
+        """
+        Once door is OPEN, notify every time the timer reaches the config settings nag time
+        value, and until we've nagged the number of times, also specified in config settings.
+        This nag can be set to zero in settings.
+        """
+        with self._door_lock:
+            d = self.door(n)
+            if (d.state == "OPEN" or d.state == "STALLED") and d.nag_limit > 0:
+                d.event_time = time.time()
+                if d.nag_limit > 1:
+                    self.try_notify(self.subject, "Garage Door {} is still Open ({})".format(n,d.nag_limit), door=n)
+                else:
+                    self.try_notify(self.subject, "OK. I'll stop nagging, but Garage Door {} is still Open".format(n,d.nag_limit), door=n)
+                self.set_nag_limit(n, d.nag_limit - 1)
+                self.stats.nag(n, d.event_time)
+            self.schedule_door(n)
+
+    def door_closed_reminder(self, n):
+        with self._door_lock:
+            d = self.door(n)
+            if d.state == "CLOSED":
+                d.event_time = time.time()
+                self.try_notify(self.subject, "Garage Door %s is still Closed" % n, door=n, low=True)
+            self.schedule_door(n)
+
+    def quarter_reminder(self, qh):
+        """
+        Notify every top and quarter of the hour a door remains open, if set
+        to do so in config settings.
+        """
+        s = self.settings
+        if s['ntfy_gdq'][qh] == 'on':
+            for n in s['sensor']:
+                if s['sensor'][n]['pin'] and self.door(n).state in ("OPEN", "STALLED"):
+                    self.try_notify(self.subject, "Friendly reminder that garage door {} is still OPEN.".format(n), door=n, low=True)
+        self.schedule_quarter()
 
+    def smtp_expire(self):
+        smtp_session.expire()  # drop the cached SMTP connection once idle
+        self.timers.schedule(time.time() + SMTP_IDLE_TIMEOUT, 'smtp', self.smtp_expire)
 
+    def run(self):
+        self.add_status('Garage plugin starting...')
+        try:
+            self.settings = get_data()
+            self.add_doors(self.settings)
+            self.status_log.set_file(STATUS_LOG_FILE if self.settings['log_file'] == 'on' else None)
+            self.stats.load()
+            self.outbox.start()
+            self._edge_thread = Thread(target=self.edge_loop, name='garage-edges')
+            self._edge_thread.daemon = True
+            self._edge_thread.start()
+            self.sampler.configure(self.settings['sens_rate'], self.settings['sens_win'])
+            self.sampler.start()
+            self.setup_gpio(self.settings)
+            self.restore_state()
+            self.actuator.window = self.settings['rly_dup'] / 1000.0
+            self.actuator.start()
+
+            gv.gc_door_state = self._door_state
+            gv.gc_started = True
+            self.schedule_all()
+
+            errors = 0  # consecutive monitor loop errors
+            while not self._halt.is_set():
+                try:
+                    # Sleep until the next reminder, nag or move timeout is due, or until a
+                    # door event re-arms the timers or stop() wakes us, then monitor door
+                    # state and notify.
+                    self.timers.wait()
+                    loop_iterations.inc()
+                    if not self._halt.is_set():
+                        self.timers.run_due()
+                    errors = 0
 #
-# Keep time when this plugin started its thread. Then if it restarts, any 
-# running threads can know to stop, so we don't get multiples running.
-gv.gc_started = False
-gv.gc_start = time.time()
+# TODO FIXME : * maybe add an option to close door after being open for a specified time
+#
+                except Exception:
+                    exc_type, exc_value, exc_traceback = sys.exc_info()
+                    err_string = ''.join(traceback.format_exception(exc_type, exc_value, exc_traceback))
+                    self.add_status('Garage Control plugin encountered error:\n' + err_string, level='ERROR')
+                    self._halt.wait(min(LOOP_RETRY_MAX, LOOP_RETRY * 2 ** errors))
+                    errors += 1
+                    self.schedule_all()  # the failed timer was consumed, so re-arm everything
+        finally:
+            self.release()
+            self.shutdown()
+            self._released.set()
+
+    def stop(self, timeout=10):
+        """
+        Stop the controller thread. Returns once GPIO event detection, menus
+        and urls have been released, state, stats, history and settings
+        have been written, and the notification workers and the outbox have
+        stopped, so a new controller can take over the same files. Nothing
+        here waits on the network for more than NOTIFY_STOP_TIMEOUT.
+        """
+        self._halt.set()
+        self.timers.wake()
+        if self.is_alive():
+            if not self._released.wait(timeout):
+                print('Error: garage controller did not stop within %d seconds' % timeout)
+        else:
+            self.release()
 
-# Start an instance of Garage controller thread
-# TODO FIXME : add support for "pi" gpio_pins. Only supporting GPIO for now...
-#if gv.use_pigpio:
-#    controller = GarageControl(pi)
-#else:
-#    controller = GarageControl(GPIO)
-controller = GarageControl(GPIO)
+    def release(self):
+        """
+        Give up the inputs and outputs a new controller needs: GPIO event
+        detection, the edge thread, the relays, plugin menu items and urls.
+        """
+        if self._released.is_set():
+            return
+        if self.settings:
+            s = self.settings['sensor']
+            for n in s:
+                if s[n]['pin']:
+                    self.remove_sensor(s[n]['pin'])
+        self.sampler.stop()
+        if self._edge_thread is not None:
+            self._edges.put(None)  # stop the edge thread
+            self._edge_thread.join(1)
+        self.actuator.stop()
+        self.events.close()
+        # remove menu items/urls, so we don't keep expanding the lists!
+        for m in self.menus:
+            if m in gv.plugin_menu:
+                gv.plugin_menu.remove(m)
+        for v in plugin_urls:
+            if v in urls:
+                urls.remove(v)
+        gv.gc_started = False
+
+    def shutdown(self):
+        """
+        Stop the notification workers and the outbox, then write state,
+        stats, history and settings for the next controller.
+        """
+        print(time.strftime("%c") + ", Exiting Thread\n") 
+        self.add_status(time.strftime("%c") + ", Exiting Thread\n") 
+        self.outbox.halt()  # so it doesn't start on what is put in it below
+        self.coalescer.flush()
+        left = self.notifier.stop()
+        for subject, text, queued in left:
+            self.spool_notification(subject, text, queued)
+        if left:
+            self.add_status("%d pending notification(s) kept in the outbox for the next start" % len(left))
+        self.outbox.stop()
+        closer = Thread(target=close_notifiers, name='garage-close')  # may wait on a worker still sending
+        closer.daemon = True
+        closer.start()
+        self.history.close()
+        self.save_state()
+        self.save_stats()
+        self.write_settings()
 
 
 ################################################################################
@@ -433,10 +2601,18 @@ controller = GarageControl(GPIO)
 class settings(ProtectedPage):
     """
     Load an html page for entering plugin settings.
+    The page lists every relay and sensor, plus an empty one of each,
+    which is added when it's saved with a pin number.
     """
     def GET(self):
-        settings = get_data()
-        return template_render.garage(settings)  # open settings page
+        s = get_data()
+        view = dict(s, status=controller.status)
+        for group in ('relay', 'sensor'):
+            numbers = door_numbers(s[group])
+            new = str(int(numbers[-1]) + 1) if numbers else '1'
+            view[group] = dict(s[group], **{new: NEW_ENTRY[group]})
+            view[group + 's'] = numbers + [new]
+        return template_render.garage(view)  # open settings page
 
 
 class save_settings(ProtectedPage):
@@ -444,271 +2620,621 @@ class save_settings(ProtectedPage):
     Save user input to json file.
     Will create or update file when SUBMIT button is clicked
     CheckBoxes only appear in qdict if they are checked,
-    so test and set accordingly.
+    so test and set accordingly (see form_value).
     """
     def GET(self):
         qdict = web.input()  # Dictionary of values returned as query string from settings page.
+        settings = thaw(get_data())  # edit a copy, the live snapshot is read-only
 
         # print "save_settings: qdict:"
         # print qdict  # for testing
         # print
 
-        if 'relay1_ena' not in qdict:
-            controller.settings['relay']['1']['ena'] = 0
-        else:
-            controller.settings['relay']['1']['ena'] = 1
+        for group, form in (('relay', RELAY_FORM), ('sensor', SENSOR_FORM)):
+            for k in qdict:
+                n = k[len(group):-len('_pin')]
+                if not (k.startswith(group) and k.endswith('_pin') and n.isdigit()):
+                    continue
+                entry = settings[group].get(n)
+                if entry is None:
+                    if qdict[k] in ('', '0'):
+                        continue  # the empty slot was left empty
+                    entry = settings[group][n] = dict(NEW_ENTRY[group])
+                for field, key, kind in form:
+                    entry[key] = form_value(qdict, '%s%s_%s' % (group, n, field), kind, entry[key])
+
+        for key, kind in SETTINGS_FORM:
+            if isinstance(kind, tuple):
+                for i, k in enumerate(kind):
+                    settings[key][i] = form_value(qdict, '%s[%d]' % (key, i), k, settings[key][i])
+            else:
+                settings[key] = form_value(qdict, key, kind, settings[key])
+
+        controller.apply_settings(settings_cache.put(settings))  # applied in place, no restart needed
+        controller.write_settings_soon()
+        raise web.seeother(u"/")  # return to home page
 
-        if 'relay1_pin' in qdict and qdict['relay1_pin'] != '':
-            controller.settings['relay']['1']['pin'] = int(qdict['relay1_pin'])
 
-        if 'relay1_pol' not in qdict:
-            controller.settings['relay']['1']['pol'] = 0
-        else:
-            controller.settings['relay']['1']['pol'] = 1
+class ospi_home_page(ProtectedPage):
+    def GET(self):
+        raise web.seeother(u"/")  # return to home page
 
-        if 'relay1_opa' not in qdict:
-            controller.settings['relay']['1']['prm'] = 0
-        else:
-            controller.settings['relay']['1']['prm'] = 1
+class garage_button(ProtectedPage):
+    """
+    /garage-b<n> presses the button of relay n.
+    """
+    def GET(self, n):
+        if n not in controller.settings.get('relay', {}):
+            raise web.notfound()
+        controller.press_button(n)
+        raise web.seeother(u"/")  # return to home page
 
-        if 'relay1_iad' not in qdict:
-            controller.settings['relay']['1']['typ'] = 0
-        else:
-            controller.settings['relay']['1']['typ'] = 1
+class garage_stop_nagging(ProtectedPage):
+    def GET(self):
+        controller.clear_nag_limit()
+        raise web.seeother(u"/")  # return to home page
 
-        if 'relay2_ena' not in qdict:
-            controller.settings['relay']['2']['ena'] = 0
-        else:
-            controller.settings['relay']['2']['ena'] = 1
 
-        if 'relay2_pin' in qdict and qdict['relay2_pin'] != '':
-            controller.settings['relay']['2']['pin'] = int(qdict['relay2_pin'])
+class api_status(ProtectedPage):
+    """
+    Door states, nag status and recent events as JSON.
+    Honors If-None-Match, so frequent polling gets a cheap 304.
+    Optional query: events=<number of recent status records, up to STATUS_LOG_SIZE>
+    """
+    def GET(self):
+        qdict = web.input(events=API_EVENTS)
+        try:
+            events = max(0, min(STATUS_LOG_SIZE, int(qdict['events'])))
+        except ValueError:
+            raise web.badrequest()
+        etag = '"%d-%d"' % (controller.version, events)
+        web.header('ETag', etag)
+        web.header('Cache-Control', 'no-cache')
+        if web.ctx.env.get('HTTP_IF_NONE_MATCH') == etag:
+            raise web.notmodified()
+        return json_response(controller.api_status(events))
+
+class api_press(ProtectedPage):
+    """
+    Press a garage button without redirecting to the home page.
+    The press is queued, so state is the door state before it; queued is
+    false if the press was ignored as a repeat.
+    Query: door=<relay number>
+    """
+    def GET(self):
+        qdict = web.input()
+        door = qdict.get('door')
+        if door not in controller.settings.get('relay', {}):
+            raise web.notfound()
+        queued = controller.press_button(door)
+        return json_response({'door': door, 'state': controller.door(door).state, 'queued': queued})
 
-        if 'relay2_pol' not in qdict:
-            controller.settings['relay']['2']['pol'] = 0
-        else:
-            controller.settings['relay']['2']['pol'] = 1
+    POST = GET
 
-        if 'relay2_opa' not in qdict:
-            controller.settings['relay']['2']['prm'] = 0
-        else:
-            controller.settings['relay']['2']['prm'] = 1
+class api_stop_nagging(ProtectedPage):
+    """
+    Stop nagging for every door, or only for the door given as door=<number>.
+    """
+    def GET(self):
+        qdict = web.input(door=None)
+        door = qdict['door'] or None
+        if door is not None and door not in controller.doors:
+            raise web.notfound()
+        controller.clear_nag_limit(door)
+        return json_response({'nag': gv.gc_nag})
 
-        if 'relay2_iad' not in qdict:
-            controller.settings['relay']['2']['typ'] = 0
-        else:
-            controller.settings['relay']['2']['typ'] = 1
+    POST = GET
 
-        if 'sensor1_ena' not in qdict:
-            controller.settings['sensor']['1']['ena'] = 0
-        else:
-            controller.settings['sensor']['1']['ena'] = 1
+class api_events(ProtectedPage):
+    """
+    Server-Sent Events stream of door transitions ('door'), relay presses
+    ('press'), nag changes ('nag') and notification outcomes ('notify').
+    A comment is sent every SSE_HEARTBEAT seconds to keep the connection
+    alive and to notice a client that has gone away. At most SSE_CLIENTS
+    streams are open; a new one ends the oldest.
+    """
+    def GET(self):
+        client = controller.events.subscribe()
+        web.header('Content-Type', 'text/event-stream')
+        web.header('Cache-Control', 'no-cache')
+        web.header('X-Accel-Buffering', 'no')
 
-        if 'sensor1_pin' in qdict and qdict['sensor1_pin'] != '':
-            controller.settings['sensor']['1']['pin'] = int(qdict['sensor1_pin'])
+        def stream():
+            try:
+                yield 'retry: 3000\n\n'
+                yield 'event: status\ndata: %s\n\n' % json.dumps(controller.api_status(0))
+                while not client.closed:
+                    event = client.get(SSE_HEARTBEAT)
+                    if event is None:
+                        yield ': heartbeat\n\n'
+                    else:
+                        yield 'id: %d\nevent: %s\ndata: %s\n\n' % event
+            finally:
+                controller.events.unsubscribe(client)
+        return stream()
 
-        if 'sensor1_pud' not in qdict:
-            controller.settings['sensor']['1']['pud'] = 0
-        else:
-            controller.settings['sensor']['1']['pud'] = 1
+class api_history(ProtectedPage):
+    """
+    Door events and open intervals for a time range, as JSON.
+    Query: start, end (epoch seconds; default the last HISTORY_SPAN seconds), door
+    """
+    def GET(self):
+        qdict = web.input(door=None, start=None, end=None)
+        try:
+            end = float(qdict['end']) if qdict['end'] else time.time()
+            start = float(qdict['start']) if qdict['start'] else end - HISTORY_SPAN
+        except ValueError:
+            raise web.badrequest()
+        door = qdict['door'] or None
+        doors = [door] if door else sorted(controller.settings.get('sensor', {}))
+        return json_response({
+            'start' : start,
+            'end'   : end,
+            'events': [dict(zip(('ts', 'door', 'kind', 'state'), e))
+                       for e in controller.history.events(start, end, door)],
+            'open'  : dict((n, controller.history.open_intervals(start, end, n)) for n in doors),
+        })
+
+class api_metrics(ProtectedPage):
+    """
+    Latency histograms and counters in the Prometheus text exposition format.
+    """
+    def GET(self):
+        web.header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        return metrics.render()
 
-        if 'sensor2_ena' not in qdict:
-            controller.settings['sensor']['2']['ena'] = 0
-        else:
-            controller.settings['sensor']['2']['ena'] = 1
+class api_stats(ProtectedPage):
+    """
+    Usage statistics per door from the hourly and daily rollups: seconds
+    open, open cycles, longest open interval, nags and presses.
+    Query: door (default all), hours (default 24, 1 to STATS_HOURS),
+    days (default 30, 1 to STATS_DAYS)
+    """
+    def GET(self):
+        qdict = web.input(door=None, hours=24, days=30)
+        try:
+            hours = max(1, min(STATS_HOURS, int(qdict['hours'])))
+            days = max(1, min(STATS_DAYS, int(qdict['days'])))
+        except ValueError:
+            raise web.badrequest()
+        door = qdict['door'] or None
+        doors = [door] if door else door_numbers(controller.settings.get('sensor', {}))
+        return json_response(dict((n, controller.stats.report(n, hours, days)) for n in doors))
+
+class api_sensors(ProtectedPage):
+    """
+    Sample windows of the polled sensors, for diagnosing noisy wiring:
+    per door, the voted level, the samples (oldest first, a 1 is open),
+    and how often the level changed.
+    """
+    def GET(self):
+        sampler = controller.sampler
+        history = sampler.history()
+        s = controller.settings['sensor']
+        return json_response({
+            'poll'    : controller.settings['sens_poll'] == 'on',
+            'rate'    : round(1 / sampler.period),
+            'window'  : sampler.window,
+            'overruns': sampler.overruns,
+            'sensors' : dict((n, history[s[n]['pin']]) for n in s if s[n]['pin'] in history),
+        })
+
+class api_notifiers(ProtectedPage):
+    """
+    The notification backends: enabled, loaded (imported and set up),
+    messages waiting in the outbox, and a health check of the enabled ones.
+    """
+    def GET(self):
+        s = controller.settings
+        enabled = controller.channels()
+        pending = controller.outbox.pending()
+        result = {}
+        for channel, backend in NOTIFIERS.items():
+            info = {'title': backend.title, 'enabled': channel in enabled,
+                    'loaded': channel in _notifiers, 'outbox': pending.get(channel, 0)}
+            if info['enabled']:
+                info['ok'], info['detail'] = get_notifier(channel).health(s)
+            result[channel] = info
+        return json_response(result)
 
-        if 'sensor2_pin' in qdict and qdict['sensor2_pin'] != '':
-            controller.settings['sensor']['2']['pin'] = int(qdict['sensor2_pin'])
 
-        if 'sensor2_pud' not in qdict:
-            controller.settings['sensor']['2']['pud'] = 0
-        else:
-            controller.settings['sensor']['2']['pud'] = 1
 
+################################################################################
+# helper methods
+#
+#
+# Default settings, used for any key missing from the data file.
+#
+# Note: OSPi uses GPIO BOARD mode
+#       (i.e., pin 16 == gpio 23), so set pins accordingly.
+# Default supports 2 relays, and 2 sensors. More can be added
+# from the settings page.
+#
+DEFAULT_SETTINGS = {
+    # default relay/sensor settings using unused ospi gpio pins
+    'relay'      : { '1':{'ena':1, 'pin':16, 'pol':1, 'prm':1, 'typ':1},
+                     '2':{'ena':1, 'pin':18, 'pol':1, 'prm':1, 'typ':0} },
+    'sensor'     : { '1':{'ena':1, 'pin':22, 'pud':1},
+                     '2':{'ena':1, 'pin':0 , 'pud':1} },
+    'sens_stl'   : 1250,  # sensor settle (debounce) time, ms
+    'sens_poll'  : 'off',  # poll the sensors instead of edge events, for noisy wiring
+    'sens_rate'  : 50,  # polled sensor samples per second
+    'sens_win'   : 16,  # polled sensor samples voted on; the debounce time is sens_win / sens_rate
+    'rly_dup'    : 1000,  # ms; repeated presses of a relay within this time are ignored
+    'mail_en'    : 'off',
+    'mail_srv'   : 'smtp.gmail.com',
+    'mail_port'  : 465,
+    'mail_ssl'   : 'on',  # 'off' for plain SMTP to a local relay
+    'mail_usr'   : '',
+    'mail_pwd'   : '',
+    'mail_adr'   : '',
+    'ntfy_log'   : 'off',
+    'log_file'   : 'off',
+    'ntfy_rain'  : 'off',
+    'ntfy_run'   : 'off',
+    'ntfy_gev'   : 'off',
+    'ntfy_gdo'   : [ 'on', 300, 6 ],
+    'ntfy_gdq'   : [ 'on', 'off', 'off', 'off' ],
+    'ntfy_gdc'   : [ 'off', 0, 0 ],
+    'ntfy_win'   : 60,  # s; merge notifications about the same door, 0 = off
+    'ntfy_dig'   : [ 'off', 3600 ],  # hold reminders for a digest every N seconds
+    'twil_en'    : 'off',
+    'twil_sid'   : '',
+    'twil_atok'  : '',
+    'twil_to'    : '',
+    'twil_from'  : '',
+    'hook_en'    : 'off',
+    'hook_url'   : '',
+    'file_en'    : 'off',  # append notifications to NOTIFY_LOG
+    'sysl_en'    : 'off',
+}
+
+# Settings for a relay or sensor added from the settings page
+NEW_ENTRY = {
+    'relay'      : {'ena':1, 'pin':0, 'pol':1, 'prm':1, 'typ':1},
+    'sensor'     : {'ena':1, 'pin':0, 'pud':1},
+}
 
-        if 'mail_en' not in qdict:
-            controller.settings['mail_en'] = 'off'
-        else:
-            controller.settings['mail_en'] = qdict['mail_en']
-
-        if 'mail_usr' in qdict and qdict['mail_usr'] != '':
-            controller.settings['mail_usr'] = qdict['mail_usr']
-
-        #
-        # note: I recommend you use a burner gmail account, that can
-        # forward notifications on to other emails, or send to
-        # a mobile provider's SMS gateway address, i.e.,
-        # 5555555555@vtext.com, etc. See this page for a good list:
-        # https://en.wikipedia.org/wiki/SMS_gateway
-        #
-        if 'mail_pwd' in qdict and qdict['mail_pwd'] != '':
-            controller.settings['mail_pwd'] = qdict['mail_pwd']
-
-        if 'mail_adr' in qdict and qdict['mail_adr'] != '':
-            controller.settings['mail_adr'] = qdict['mail_adr']
-
-        if 'ntfy_log' not in qdict:
-            controller.settings['ntfy_log'] = 'off'
-        else:
-            controller.settings['ntfy_log'] = qdict['ntfy_log']
+#
+# Settings page form schema.
+# Relays and sensors: (form field, settings key, kind); the form field
+# of relay n is 'relay<n>_<field>', e.g. relay1_pin.
+# Everything else: (settings key, kind), or a tuple of kinds for list
+# settings, whose form fields are '<key>[<index>]'.
+#   'bool'  - checkbox, stored as 1/0
+#   'check' - checkbox, stored as 'on'/'off'
+#   'int'   - number, unchanged if left blank
+#   'text'  - text, unchanged if left blank
+#
+RELAY_FORM = (
+    ('ena', 'ena', 'bool'),
+    ('pin', 'pin', 'int'),
+    ('pol', 'pol', 'bool'),
+    ('opa', 'prm', 'bool'),
+    ('iad', 'typ', 'bool'),
+)
+SENSOR_FORM = (
+    ('ena', 'ena', 'bool'),
+    ('pin', 'pin', 'int'),
+    ('pud', 'pud', 'bool'),
+)
+#
+# note: I recommend you use a burner gmail account, that can
+# forward notifications on to other emails, or send to
+# a mobile provider's SMS gateway address, i.e.,
+# 5555555555@vtext.com, etc. See this page for a good list:
+# https://en.wikipedia.org/wiki/SMS_gateway
+#
+SETTINGS_FORM = (
+    ('sens_stl'  , 'int'),
+    ('sens_poll' , 'check'),
+    ('sens_rate' , 'int'),
+    ('sens_win'  , 'int'),
+    ('rly_dup'   , 'int'),
+    ('mail_en'   , 'check'),
+    ('mail_srv'  , 'text'),
+    ('mail_port' , 'int'),
+    ('mail_ssl'  , 'check'),
+    ('mail_usr'  , 'text'),
+    ('mail_pwd'  , 'text'),
+    ('mail_adr'  , 'text'),
+    ('ntfy_log'  , 'check'),
+    ('log_file'  , 'check'),
+    ('ntfy_rain' , 'check'),
+    ('ntfy_run'  , 'check'),
+    ('ntfy_gev'  , 'check'),
+    ('ntfy_gdo'  , ('check', 'int', 'int')),
+    ('ntfy_gdq'  , ('check', 'check', 'check', 'check')),
+    ('ntfy_gdc'  , ('check', 'int', 'int')),
+    ('ntfy_win'  , 'int'),
+    ('ntfy_dig'  , ('check', 'int')),
+    ('twil_en'   , 'check'),
+    ('twil_sid'  , 'text'),
+    ('twil_atok' , 'text'),
+    ('twil_to'   , 'text'),
+    ('twil_from' , 'text'),
+    ('hook_en'   , 'check'),
+    ('hook_url'  , 'text'),
+    ('file_en'   , 'check'),
+    ('sysl_en'   , 'check'),
+)
+
+
+def form_value(qdict, name, kind, value):
+    """
+    New value of a setting from the settings form; value is the current one.
+    """
+    if kind == 'bool':
+        return 1 if name in qdict else 0
+    if kind == 'check':
+        return qdict[name] if name in qdict else 'off'
+    if name in qdict and qdict[name] != '':
+        return int(qdict[name]) if kind == 'int' else qdict[name]
+    return value
 
-        if 'ntfy_rain' not in qdict:
-            controller.settings['ntfy_rain'] = 'off'
-        else:
-            controller.settings['ntfy_rain'] = qdict['ntfy_rain']
 
-        if 'ntfy_run' not in qdict:
-            controller.settings['ntfy_run'] = 'off'
-        else:
-            controller.settings['ntfy_run'] = qdict['ntfy_run']
+def freeze(obj):
+    """
+    Read-only copy of a settings structure: dicts become mapping proxies
+    and lists become tuples.
+    """
+    if isinstance(obj, (dict, MappingProxyType)):
+        return MappingProxyType(dict((k, freeze(v)) for k, v in obj.items()))
+    if isinstance(obj, (list, tuple)):
+        return tuple(freeze(v) for v in obj)
+    return obj
 
-        if 'ntfy_gev' not in qdict:
-            controller.settings['ntfy_gev'] = 'off'
-        else:
-            controller.settings['ntfy_gev'] = qdict['ntfy_gev']
+def thaw(obj):
+    """
+    Mutable (and JSON serializable) copy of a frozen settings structure.
+    """
+    if isinstance(obj, (dict, MappingProxyType)):
+        return dict((k, thaw(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return [thaw(v) for v in obj]
+    return obj
 
-        if 'ntfy_gdo[0]' not in qdict:
-            controller.settings['ntfy_gdo'][0] = 'off'
-        else:
-            controller.settings['ntfy_gdo'][0] = qdict['ntfy_gdo[0]']
-        controller.settings['ntfy_gdo'][1] = int(qdict['ntfy_gdo[1]'])
-        controller.settings['ntfy_gdo'][2] = int(qdict['ntfy_gdo[2]'])
-        
-        if 'ntfy_gdq[0]' not in qdict:
-            controller.settings['ntfy_gdq'][0] = 'off'
-        else:
-            controller.settings['ntfy_gdq'][0] = qdict['ntfy_gdq[0]']
-        if 'ntfy_gdq[1]' not in qdict:
-            controller.settings['ntfy_gdq'][1] = 'off'
-        else:
-            controller.settings['ntfy_gdq'][1] = qdict['ntfy_gdq[1]']
-        if 'ntfy_gdq[2]' not in qdict:
-            controller.settings['ntfy_gdq'][2] = 'off'
-        else:
-            controller.settings['ntfy_gdq'][2] = qdict['ntfy_gdq[2]']
-        if 'ntfy_gdq[3]' not in qdict:
-            controller.settings['ntfy_gdq'][3] = 'off'
-        else:
-            controller.settings['ntfy_gdq'][3] = qdict['ntfy_gdq[3]']
 
-        if 'ntfy_gdc[0]' not in qdict:
-            controller.settings['ntfy_gdc'][0] = 'off'
-        else:
-            controller.settings['ntfy_gdc'][0] = qdict['ntfy_gdc[0]']
-        controller.settings['ntfy_gdc'][1] = int(qdict['ntfy_gdc[1]'])
-        controller.settings['ntfy_gdc'][2] = int(qdict['ntfy_gdc[2]'])
-        
-        if 'twil_en' not in qdict:
-            controller.settings['twil_en'] = 'off'
-        else:
-            controller.settings['twil_en'] = qdict['twil_en']
-        if 'twil_sid' in qdict and qdict['twil_sid'] != '':
-            controller.settings['twil_sid'] = qdict['twil_sid']
-        if 'twil_atok' in qdict and qdict['twil_atok'] != '':
-            controller.settings['twil_atok'] = qdict['twil_atok']
-        if 'twil_to' in qdict and qdict['twil_to'] != '':
-            controller.settings['twil_to'] = qdict['twil_to']
-        if 'twil_from' in qdict and qdict['twil_from'] != '':
-            controller.settings['twil_from'] = qdict['twil_from']
+class SettingsCache(object):
+    """
+    Immutable snapshot of the plugin settings. The data file is only parsed
+    again when its mtime or size changes, and a reload swaps in a whole new
+    snapshot, so readers never see a half-merged config.
+    New settings are installed by put() at once, and written by flush(),
+    which replaces the data file atomically and skips the write when the
+    file already holds the same settings.
+    """
+    def __init__(self, path=DATA_FILE):
+        self.path = path
+        self._lock = Lock()
+        self._stamp = None
+        self._snapshot = None
+        self._saved = None   # serialized settings the data file holds
+        self._dirty = False  # put() since the last flush()
+
+    def _file_stamp(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    def get(self):
+        stamp = self._file_stamp()
+        snapshot = self._snapshot
+        if snapshot is not None and stamp == self._stamp:
+            return snapshot
+        with self._lock:
+            if self._snapshot is None or stamp != self._stamp:
+                settings = self._load()
+                self._snapshot = freeze(settings)
+                self._saved = self._serialize(settings)
+                self._stamp = stamp
+                self._dirty = False
+            return self._snapshot
+
+    def _serialize(self, settings):
+        return json.dumps(settings, indent=4, sort_keys=True)  # as SIP's jsave writes it
+
+    def _load(self):
+        settings = thaw(DEFAULT_SETTINGS)
+        try:
+            with open(self.path, 'r') as fh:  # Read settings from json file if it exists
+                try:
+                    _data_items = json.load(fh)
+                    for key in _data_items:
+                        if key in settings:
+                            settings[key] = _data_items[key]
+                except ValueError as e:
+                    print("Garage pluging couldn't parse data file:", e)
+            print("Garage Plugin settings data file loaded")
+        except IOError as e:
+            print("Using Garage Plugin default settings: ", e)
+        return settings
+
+    def put(self, settings):
+        """
+        Install new settings; flush() writes them to the data file.
+        """
+        with self._lock:
+            self._snapshot = freeze(settings)
+            self._dirty = True
+        return self._snapshot
 
+    def flush(self):
+        """
+        Write the settings installed by put(), unless the data file already
+        holds them. Returns True if the file was written.
+        """
+        with self._lock:
+            if not self._dirty:
+                return False
+            data = self._serialize(thaw(self._snapshot))
+            self._dirty = False
+            if data == self._saved:
+                return False
+            try:
+                atomic_write(self.path, data)
+            except Exception:
+                self._dirty = True
+                raise
+            self._saved = data
+            self._stamp = self._file_stamp()
+            return True
 
-        # don't save status in the data file
-        controller.settings['status'] = ""
-        jsave(controller.settings, 'garage');
-        controller.settings['status'] = controller.status
-        raise web.seeother(u"/restart")  # restart after settings change required
 
+settings_cache = SettingsCache()
 
-class ospi_home_page(ProtectedPage):
-    def GET(self):
-        raise web.seeother(u"/")  # return to home page
 
-class garage_button_1(ProtectedPage):
-    def GET(self):
-        controller.press_button('1')
-        raise web.seeother(u"/")  # return to home page
+def get_data():
+    """
+    Get settings from data/garage.json, or use defaults if the
+    data file does not exist. Returns a read-only snapshot; the file is
+    only read again after it changed.
+    """
+    return settings_cache.get()
 
-class garage_button_2(ProtectedPage):
-    def GET(self):
-        controller.press_button('2')
-        raise web.seeother(u"/")  # return to home page
 
-class garage_stop_nagging(ProtectedPage):
-    def GET(self):
-        controller.clear_nag_limit()
-        raise web.seeother(u"/")  # return to home page
+def atomic_write(path, data):
+    """
+    Replace the file at path with data, so that a crash leaves either the old
+    or the new content: write a temp file, fsync it, then rename it over path.
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as fh:
+        fh.write(data)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp, path)
 
 
+def json_response(data):
+    web.header('Content-Type', 'application/json')
+    return json.dumps(data)
 
-################################################################################
-# helper methods
-#
-def get_data():
-    """
-    Get settings from data/garage.json, or use defaults if the
-    data file does not exist.
 
-    Note: OSPi uses GPIO BOARD mode
-          (i.e., pin 16 == gpio 23), so set pins accordingly.
-    Default supports 2 relays, and 2 sensors. Expand as needed.
+class SmtpSession(object):
     """
-    # default relay/sensor settings using unused ospi gpio pins
-    defaults = {
-        'relay'      : { '1':{'ena':1, 'pin':16, 'pol':1, 'prm':1, 'typ':1},
-                         '2':{'ena':1, 'pin':18, 'pol':1, 'prm':1, 'typ':0} },
-        'sensor'     : { '1':{'ena':1, 'pin':22, 'pud':1},
-                         '2':{'ena':1, 'pin':0 , 'pud':1} },
-        'mail_en'    : 'off',
-        'mail_usr'   : '',
-        'mail_pwd'   : '',
-        'mail_adr'   : '',
-        'ntfy_log'   : 'off',
-        'ntfy_rain'  : 'off',
-        'ntfy_run'   : 'off',
-        'ntfy_gev'   : 'off',
-        'ntfy_gdo'   : [ 'on', 300, 6 ],
-        'ntfy_gdq'   : [ 'on', 'off', 'off', 'off' ],
-        'ntfy_gdc'   : [ 'off', 0, 0 ],
-        'twil_en'    : 'off',
-        'twil_sid'   : '',
-        'twil_atok'  : '',
-        'twil_to'    : '',
-        'twil_from'  : '',
-        'status'     : controller.status
-    }
-    settings = {}
-    if not controller.settings:
-        settings = defaults
-    else:
-        # if settings exist don't overwrite with defaults
-        settings = controller.settings
-        # except for status
-        settings['status'] = controller.status
+    Long-lived, authenticated SMTP_SSL (or, for a local relay, plain SMTP)
+    connection shared by the email notifications. Before a message goes out
+    on a reused connection, it is checked with NOOP and re-opened if the
+    server dropped it; it is closed after idle_timeout seconds. A message
+    that fails is never sent again here, since the server may already have
+    taken it.
+    """
+    def __init__(self, idle_timeout=SMTP_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self._lock = Lock()
+        self._server = None
+        self._key = None
+        self._last_used = 0
+
+    def _connect(self, key, timeout):
+        import smtplib
+        host, port, user, pwd, use_ssl = key
+        if use_ssl:
+            server = smtplib.SMTP_SSL(host, port, context=get_ssl_context(), timeout=timeout)
+        else:
+            server = smtplib.SMTP(host, port, timeout=timeout)
+        try:
+            server.login(user, pwd)
+        except:
+            server.close()
+            raise
+        self._server = server
+        self._key = key
+        self._last_used = time.time()
+
+    def _close(self, quit=True):
+        if self._server is not None:
+            try:
+                if quit:
+                    self._server.quit()
+            except Exception:
+                pass
+            self._server.close()
+        self._server = None
+        self._key = None
+
+    def _alive(self):
+        if time.time() - self._last_used > self.idle_timeout:
+            return False
+        try:
+            return self._server.noop()[0] == 250
+        except Exception:
+            return False
+
+    def sendmail(self, host, port, user, pwd, mail_to, message, timeout=MAIL_TIMEOUT, use_ssl=True):
+        key = (host, port, user, pwd, use_ssl)
+        with self._lock:
+            self._open(key, timeout)  # a stale connection is replaced here, before the message goes out
+            try:
+                self._server.sendmail(user, mail_to, message)
+            except Exception:
+                # Don't resend: a reply may have timed out after DATA, with the
+                # message already taken. The outbox retries it later.
+                self._close(quit=False)
+                raise
+            self._last_used = time.time()
 
-    try:
-        with open(DATA_FILE, 'r') as fh:  # Read settings from json file if it exists
+    def _open(self, key, timeout):
+        """
+        Make sure a live connection for key is open; True if it is new.
+        """
+        if self._server is not None and self._key != key:
+            self._close()
+        elif self._server is not None and not self._alive():
+            self._close(quit=False)
+        if self._server is None:
+            self._connect(key, timeout)
+            return True
+        return False
+
+    def check(self, host, port, user, pwd, timeout=MAIL_TIMEOUT, use_ssl=True):
+        """
+        Open (or reuse) the connection and NOOP it; raises if that fails.
+        """
+        with self._lock:
+            self._open((host, port, user, pwd, use_ssl), timeout)
             try:
-                _data_items = json.load(fh)
-                #print(_data_items)
-                #for key, value in _data_items.iteritems():
-                for key in _data_items:
-                    if key in settings:
-                        settings[key] = _data_items[key]
-                        #print(key, settings[key])
-            except ValueError as e:
-                print("Garage pluging couldn't parse data file:", e)
-            finally:
-                fh.close()
-        print("Garage Plugin settings data file loaded")
-        settings['status'] = controller.status
-        #print settings
-    except IOError as e:
-        print("Using Garage Plugin default settings: ", e)
-        #print settings
-    return settings
+                code = self._server.noop()[0]
+            except Exception:
+                self._close()
+                raise
+            self._last_used = time.time()
+        if code != 250:
+            raise Exception(u"SMTP server answered NOOP with %d" % code)
+
+    def expire(self):
+        """
+        Close the connection if it has been idle longer than idle_timeout.
+        """
+        with self._lock:
+            if self._server is not None and time.time() - self._last_used > self.idle_timeout:
+                self._close()
+
+    def close(self):
+        with self._lock:
+            self._close()
+
 
+_ssl_context = None
 
-def send_email_insec(subject, text, attach=None):
+def get_ssl_context():
+    """
+    Create the SSL context once; loading the CA bundle is slow on a Pi.
+    """
+    global _ssl_context
+    if _ssl_context is None:
+        import ssl
+        _ssl_context = ssl.create_default_context()
+    return _ssl_context
+
+
+smtp_session = SmtpSession()
+
+
+def send_email_insec(subject, text, attach=None, timeout=MAIL_TIMEOUT):
     """
     Send email with with optional attachments
     If we have attachments, we send a MIME message,
@@ -718,10 +3244,10 @@ def send_email_insec(subject, text, attach=None):
           access to your gmail account by enabling it:
           https://support.google.com/accounts/answer/6010255?hl=en          
     """
-    smtp_server = "smtp.gmail.com" # TODO : add to settings config
-    smtp_port = 465 # TODO : add to settings config
     settings = controller.settings
     if settings['mail_usr'] != '' and settings['mail_pwd'] != '' and settings['mail_adr'] != '':
+        smtp_server = settings['mail_srv']
+        smtp_port = settings['mail_port']
         mail_user = settings['mail_usr']  # User name
         mail_from = gv.sd['name']       # OSPi name
         mail_pwd = settings['mail_pwd']   # User password
@@ -729,22 +3255,416 @@ def send_email_insec(subject, text, attach=None):
 
         message = f"""From: {mail_from}\nTo: {mail_to}\nSubject: {subject}\n{text}\n"""
 
-        ssl_context = ssl.create_default_context()
-        with smtplib.SMTP_SSL(smtp_server, smtp_port, context=ssl_context) as server:
-            server.login(mail_user, mail_pwd)
-            server.sendmail(mail_user, mail_to, message)
+        with email_seconds.time():
+            smtp_session.sendmail(smtp_server, smtp_port, mail_user, mail_pwd, mail_to, message, timeout,
+                                  use_ssl=settings['mail_ssl'] == 'on')
     else:
         raise Exception(u"E-mail settings not properly configured!")
 
-def send_sms(account_sid, auth_token, num_to, num_from, msg):
+class TokenBucket(object):
+    """
+    Token-bucket rate limiter. acquire() waits for a token rather than
+    failing, so callers are queued instead of throttled by the provider.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._stamp = time.monotonic()
+        self._lock = Lock()
+
+    def acquire(self, timeout=None):
+        end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._stamp) * self.rate)
+                self._stamp = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if end is not None and now + wait > end:
+                return False
+            time.sleep(wait)
+
+
+class TwilioClient(object):
+    """
+    Minimal Twilio REST client that keeps its HTTP(S) connection open
+    between messages. The base URL can point at a local HTTP server
+    standing in for the Twilio API, and the twilio python library is not
+    needed.
+    """
+    def __init__(self, account_sid, auth_token, base=TWILIO_API, timeout=SMS_TIMEOUT):
+        import base64
+        from urllib.parse import urlsplit, quote
+        url = urlsplit(base)
+        self._https = url.scheme == 'https'
+        self._host = url.netloc
+        self._path = '%s/2010-04-01/Accounts/%s' % (url.path.rstrip('/'), quote(account_sid))
+        token = base64.b64encode(('%s:%s' % (account_sid, auth_token)).encode('utf-8')).decode('ascii')
+        self._headers = {
+            'Authorization': 'Basic ' + token,
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'Accept': 'application/json',
+        }
+        self.timeout = timeout
+        self._conn = None
+        self._lock = Lock()
+
+    def _connection(self):
+        import http.client
+        if self._conn is None:
+            if self._https:
+                self._conn = http.client.HTTPSConnection(self._host, timeout=self.timeout,
+                                                         context=get_ssl_context())
+            else:
+                self._conn = http.client.HTTPConnection(self._host, timeout=self.timeout)
+        return self._conn
+
+    def _request(self, method, path, data=None):
+        import http.client
+        with self._lock:
+            while True:
+                reused = self._conn is not None
+                resp = None
+                try:
+                    conn = self._connection()
+                    conn.request(method, self._path + path, data, self._headers)
+                    resp = conn.getresponse()
+                    payload = resp.read()
+                    break
+                except (http.client.HTTPException, OSError) as err:
+                    self._close()
+                    # Retry once on a new connection only if the kept-alive one had gone
+                    # stale: the send failed, or the server hung up before any response.
+                    # Anything else, a timeout above all, may come after Twilio took the
+                    # message, and sending it again would duplicate it.
+                    if not reused or resp is not None or not isinstance(err, (BrokenPipeError, ConnectionResetError)):
+                        raise
+            if resp.will_close:
+                self._close()
+        if resp.status >= 300:
+            raise Exception(u"Twilio error %d: %s" % (resp.status, payload[:200]))
+        return json.loads(payload.decode('utf-8'))
+
+    def send_message(self, num_to, num_from, body):
+        from urllib.parse import urlencode
+        return self._request('POST', '/Messages.json', urlencode({'To': num_to, 'From': num_from, 'Body': body}))
+
+    def account(self):
+        """
+        Fetch the account record, to check the credentials.
+        """
+        return self._request('GET', '.json')
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+        self._conn = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+
+_twilio_clients = {}
+_twilio_lock = Lock()
+
+def get_twilio_client(account_sid, auth_token, timeout=SMS_TIMEOUT):
+    """
+    Return the cached client for these credentials, creating it on first use.
+    """
+    key = (account_sid, auth_token)
+    with _twilio_lock:
+        client = _twilio_clients.get(key)
+        if client is None:
+            client = TwilioClient(account_sid, auth_token, TWILIO_API, timeout)
+            _twilio_clients[key] = client
+        return client
+
+def close_twilio_clients():
+    with _twilio_lock:
+        for client in _twilio_clients.values():
+            client.close()
+        _twilio_clients.clear()
+
+
+sms_bucket = TokenBucket(SMS_RATE, SMS_BURST)
+
+
+def send_sms(account_sid, auth_token, num_to, num_from, msg, timeout=SMS_TIMEOUT):
     if account_sid != '' and auth_token != '' and num_to != '' and num_from != '':
         # send SMS via Twilio
+        sms_bucket.acquire()
         try:
-            client = TwilioRestClient(account_sid, auth_token)
-            message = client.messages.create(to=num_to, from_=num_from, body=msg)
-            print(message)
-        except:
-            raise Exception(u"Twilio send failed")
+            client = get_twilio_client(account_sid, auth_token, timeout)
+            with sms_seconds.time():
+                message = client.send_message(num_to, num_from, msg)
+            print(message.get('sid'))
+        except Exception as err:
+            raise Exception(u"Twilio send failed: " + str(err))
     else:
         raise Exception(u"Twilio settings not properly configured!")
 
+
+################################################################################
+# Notification backends
+#
+# Every notification channel is a backend class registered in NOTIFIERS
+# under its channel name, and enabled by its 'enable' setting. A backend is
+# created the first time its channel is used, and only then imports the
+# modules it needs.
+#
+NOTIFIERS = {}  # channel -> backend class, in the order the channels are sent
+
+def notifier(cls):
+    """
+    Class decorator that registers a notification backend.
+    """
+    NOTIFIERS[cls.channel] = cls
+    return cls
+
+
+class Notifier(object):
+    """
+    Base class of the notification backends.
+    send() raises if the message was not sent. send_batch() sends
+    (subject, text) messages in order and returns how many were sent, and
+    the error that stopped it or None. health() returns (ok, detail).
+    s is the plugin settings.
+    """
+    channel = None
+    title = None   # as shown in the status log
+    enable = None  # settings key that enables the channel
+
+    def send(self, s, subject, text):
+        raise NotImplementedError
+
+    def send_batch(self, s, messages):
+        sent = 0
+        for subject, text in messages:
+            try:
+                self.send(s, subject, text)
+            except Exception as err:
+                return sent, err
+            sent += 1
+        return sent, None
+
+    def health(self, s):
+        return True, 'ok'
+
+    def close(self):
+        pass
+
+
+#
+# TODO FIXME : create a new email method to use Google apps API instead of smtplib
+#              See how-to here: https://developers.google.com/gmail/api/quickstart/python
+#                               https://stackoverflow.com/questions/25944883/how-to-send-an-email-through-gmail-without-enabling-insecure-access
+#
+@notifier
+class EmailNotifier(Notifier):
+    channel = 'email'
+    title = 'Email'
+    enable = 'mail_en'
+
+    def send(self, s, subject, text):
+        #send_email_insec(subject, text, attachment)  # send email with attachment from
+        send_email_insec(subject, text, timeout=MAIL_TIMEOUT)
+
+    def health(self, s):
+        if s['mail_usr'] == '' or s['mail_pwd'] == '' or s['mail_adr'] == '':
+            return False, 'not configured'
+        try:
+            smtp_session.check(s['mail_srv'], s['mail_port'], s['mail_usr'], s['mail_pwd'],
+                               use_ssl=s['mail_ssl'] == 'on')
+        except Exception as err:
+            return False, str(err)
+        return True, 'ok'
+
+    def close(self):
+        smtp_session.close()
+
+
+@notifier
+class SmsNotifier(Notifier):
+    channel = 'sms'
+    title = 'SMS'
+    enable = 'twil_en'
+
+    def send(self, s, subject, text):
+        send_sms(s['twil_sid'], s['twil_atok'], s['twil_to'], s['twil_from'], text, timeout=SMS_TIMEOUT)
+
+    def health(self, s):
+        if '' in (s['twil_sid'], s['twil_atok'], s['twil_to'], s['twil_from']):
+            return False, 'not configured'
+        try:
+            account = get_twilio_client(s['twil_sid'], s['twil_atok']).account()
+        except Exception as err:
+            return False, str(err)
+        return account.get('status') == 'active', 'account ' + str(account.get('status'))
+
+    def close(self):
+        close_twilio_clients()
+
+
+@notifier
+class WebhookNotifier(Notifier):
+    """
+    POSTs {"source": <SIP name>, "messages": [{"subject", "text", "time"}]}
+    as JSON to the hook_url setting; a batch is a single request.
+    """
+    channel = 'webhook'
+    title = 'Webhook'
+    enable = 'hook_en'
+
+    def send(self, s, subject, text):
+        self._post(s, [(subject, text)])
+
+    def send_batch(self, s, messages):
+        try:
+            self._post(s, messages)
+        except Exception as err:
+            return 0, err
+        return len(messages), None
+
+    def _post(self, s, messages):
+        import urllib.request
+        url = s['hook_url']
+        if not url:
+            raise Exception(u"Webhook URL not configured!")
+        now = time.time()
+        body = json.dumps({
+            'source'  : gv.sd['name'],
+            'messages': [{'subject': subject, 'text': text, 'time': now} for subject, text in messages],
+        }).encode('utf-8')
+        req = urllib.request.Request(url, body, {'Content-Type': 'application/json'})
+        context = get_ssl_context() if url.startswith('https:') else None
+        with urllib.request.urlopen(req, timeout=HOOK_TIMEOUT, context=context) as resp:
+            resp.read()
+
+    def health(self, s):
+        import socket
+        from urllib.parse import urlsplit
+        url = urlsplit(s['hook_url'])
+        if url.scheme not in ('http', 'https') or not url.hostname:
+            return False, 'not configured'
+        try:
+            socket.create_connection((url.hostname, url.port or (443 if url.scheme == 'https' else 80)),
+                                     HOOK_TIMEOUT).close()
+        except OSError as err:
+            return False, str(err)
+        return True, 'ok'
+
+
+@notifier
+class FileNotifier(Notifier):
+    """
+    Appends one line per notification to NOTIFY_LOG.
+    """
+    channel = 'file'
+    title = 'File'
+    enable = 'file_en'
+
+    def __init__(self, path=NOTIFY_LOG):
+        self.path = path
+        self._lock = Lock()
+
+    def send(self, s, subject, text):
+        self.send_batch(s, [(subject, text)])
+
+    def send_batch(self, s, messages):
+        stamp = time.strftime("%Y-%m-%d %H:%M:%S")
+        lines = ''.join('%s\t%s\t%s\n' % (stamp, subject, text.strip().replace('\n', ' / '))
+                        for subject, text in messages)
+        try:
+            with self._lock:
+                with open(self.path, 'a') as fh:
+                    fh.write(lines)
+        except OSError as err:
+            return 0, err
+        return len(messages), None
+
+    def health(self, s):
+        path = self.path if os.path.exists(self.path) else os.path.dirname(self.path) or '.'
+        if not os.access(path, os.W_OK):
+            return False, path + ' is not writable'
+        return True, 'ok'
+
+
+@notifier
+class SyslogNotifier(Notifier):
+    """
+    Logs notifications to the local syslog, as daemon.notice.
+    """
+    channel = 'syslog'
+    title = 'Syslog'
+    enable = 'sysl_en'
+
+    def __init__(self):
+        import syslog
+        self._syslog = syslog
+        syslog.openlog('sip-garage', 0, syslog.LOG_DAEMON)
+
+    def send(self, s, subject, text):
+        self._syslog.syslog(self._syslog.LOG_NOTICE, '%s: %s' % (subject, text.strip().replace('\n', ' / ')))
+
+    def close(self):
+        self._syslog.closelog()
+
+
+_notifiers = {}
+_notifiers_lock = Lock()
+
+def get_notifier(channel):
+    """
+    Return the backend of a channel, creating it on first use.
+    """
+    with _notifiers_lock:
+        backend = _notifiers.get(channel)
+        if backend is None:
+            if channel not in NOTIFIERS:
+                raise Exception(u"Unknown notification channel " + channel)
+            backend = NOTIFIERS[channel]()
+            _notifiers[channel] = backend
+        return backend
+
+def close_notifiers():
+    with _notifiers_lock:
+        for backend in _notifiers.values():
+            backend.close()
+        _notifiers.clear()
+
+def channel_title(channel):
+    return NOTIFIERS[channel].title if channel in NOTIFIERS else channel
+
+
+################################################################################
+# Controller start-up
+# (last, so every helper it uses is defined before its thread runs)
+#
+# Only one controller may run. If SIP loads this plugin again, the previous
+# controller is stopped first, so we don't get multiples running.
+_previous = getattr(gv, 'gc_controller', None)
+if _previous is not None:
+    _previous.stop()
+gv.gc_started = False
+gv.gc_nag = False
+
+# Start an instance of Garage controller thread, on pigpio or RPi.GPIO, or on
+# simulated GPIO only if asked for with GARAGE_GPIO=fake. Without GPIO the
+# controller is not started (no menus or pages either), rather than quietly
+# watching simulated doors on a real install.
+if os.environ.get('GARAGE_GPIO') == 'fake':
+    controller = GarageControl(FakeGPIO())
+elif getattr(gv, 'use_pigpio', False) and pi:
+    controller = GarageControl(PigpioGPIO(pi))
+elif GPIO is not None:
+    controller = GarageControl(GPIO)
+else:
+    print('Error: Garage plugin not started, GPIO is not available (%s). '
+          'Set GARAGE_GPIO=fake to run it on simulated GPIO.' % (_gpio_error or 'gpio_pins has no GPIO'))
+    controller = None
+gv.gc_controller = controller
@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+#
+# Benchmark the Garage plugin off a Raspberry Pi.
+#
+# The plugin runs on FakeGPIO (GARAGE_GPIO=fake) in a scratch directory,
+# with email notifications going to a local SMTP stub, and we measure:
+#   - edge to door state update latency (with and without bounce storms)
+#   - relay press latency (press_button() call to relay output)
+#   - notification enqueue rate and delivery throughput
+#
+# Run it with SIP's modules importable, e.g. from the SIP directory:
+#   cd ~/SIP && python ~/sip_garage_plugin/tools/bench_garage.py
+#
+
+
+import os
+import sys
+import json
+import time
+import argparse
+import socket
+import tempfile
+import socketserver
+from threading import Thread, Lock
+
+
+###############################################################################
+# Local SMTP stub
+#
+class SmtpStub(socketserver.ThreadingTCPServer):
+    """
+    Minimal SMTP server that accepts any login and counts the messages.
+    It can answer DATA delay seconds late, or hang up without telling
+    after every message (hangup), like a server dropping idle clients.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        socketserver.ThreadingTCPServer.__init__(self, (host, port), SmtpHandler)
+        self.lock = Lock()
+        self.messages = 0
+        self.connections = 0
+        self.last_message = 0  # time.monotonic() of the last message received
+        self.subjects = []     # Subject: of every message received, in order
+        self.delay = 0
+        self.hangup = False
+        self.clients = set()   # open connections, closed by stop()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def handle_error(self, request, client_address):
+        pass  # the client gave up on a late answer
+
+    def start(self):
+        t = Thread(target=self.serve_forever, name='smtp-stub')
+        t.daemon = True
+        t.start()
+
+    def stop(self):
+        """
+        Stop listening and drop the open connections.
+        """
+        self.shutdown()
+        self.server_close()
+        with self.lock:
+            for sock in self.clients:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+
+class SmtpHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode('ascii'))
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+            server.clients.add(self.connection)
+        try:
+            self.session(server)
+        finally:
+            with server.lock:
+                server.clients.discard(self.connection)
+
+    def session(self, server):
+        self.reply('220 localhost SMTP stub')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            cmd = line.decode('ascii', 'replace').strip().split(' ')[0].upper()
+            if cmd == 'EHLO':
+                self.reply('250-localhost')
+                self.reply('250 AUTH PLAIN LOGIN')
+            elif cmd == 'HELO':
+                self.reply('250 localhost')
+            elif cmd == 'AUTH':
+                self.reply('235 2.7.0 Authentication successful')
+            elif cmd == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                subject = None
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return  # hung up before the end of the message
+                    if line in (b'.\r\n', b'.\n'):
+                        break
+                    if subject is None and line.startswith(b'Subject: '):
+                        subject = line[9:].decode('utf-8', 'replace').strip()
+                with server.lock:
+                    server.messages += 1
+                    server.last_message = time.monotonic()
+                    server.subjects.append(subject)
+                time.sleep(server.delay)
+                self.reply('250 OK')
+                if server.hangup:
+                    return
+            elif cmd == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:  # MAIL, RCPT, NOOP, RSET
+                self.reply('250 OK')
+
+
+###############################################################################
+# Helpers
+#
+results = []  # printed at the end, after the plugin's own status output
+
+def report(line):
+    results.append(line)
+
+
+def stats(name, samples, unit='ms', scale=1000.0):
+    """
+    Print min/median/p95/max of a list of samples (seconds).
+    """
+    if not samples:
+        report("%-36s no samples" % name)
+        return
+    s = sorted(samples)
+    pick = lambda q: s[min(len(s) - 1, int(q * len(s)))] * scale
+    report("%-36s n=%-5d min %8.2f  p50 %8.2f  p95 %8.2f  max %8.2f %s" %
+          (name, len(s), s[0] * scale, pick(0.5), pick(0.95), s[-1] * scale, unit))
+
+
+def wait_for(client, kind, door, state, timeout):
+    """
+    Wait for a controller event of kind for door (and state, if given).
+    Returns the monotonic receive time, or None on timeout.
+    """
+    end = time.monotonic() + timeout
+    while True:
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            return None
+        event = client.get(remaining)
+        if event is None:
+            continue
+        data = json.loads(event[2])
+        if event[1] == kind and data.get('door') == door and (state is None or data.get('state') == state):
+            return time.monotonic()
+
+
+def bench_settings(args, smtp_port):
+    doors = [str(n) for n in range(1, args.doors + 1)]
+    relays = dict((n, {'ena':1, 'pin':100 + int(n), 'pol':1, 'prm':1, 'typ':1}) for n in doors)
+    relays[str(args.doors + 1)] = {'ena':1, 'pin':100 + args.doors + 1, 'pol':1, 'prm':1, 'typ':0}
+    return {
+        'relay'    : relays,
+        'sensor'   : dict((n, {'ena':1, 'pin':200 + int(n), 'pud':1}) for n in doors),
+        'sens_stl' : args.settle,
+        'mail_en'  : 'on',
+        'mail_srv' : '127.0.0.1',
+        'mail_port': smtp_port,
+        'mail_ssl' : 'off',
+        'mail_usr' : 'bench',
+        'mail_pwd' : 'bench',
+        'mail_adr' : 'bench@localhost',
+        'ntfy_gev' : 'off',
+        'ntfy_gdo' : ['off', 300, 0],
+        'ntfy_gdq' : ['off', 'off', 'off', 'off'],
+        'ntfy_gdc' : ['off', 0, 0],
+        'twil_en'  : 'off',
+    }
+
+
+###############################################################################
+# Benchmarks
+#
+def bench_edges(garage, args, storm):
+    """
+    Flip each door sensor and time the edge (the last one, for a storm)
+    until the controller publishes the new door state. Edges on a pin are
+    spaced by the GPIO bouncetime, or the first one would be filtered out.
+    """
+    c = garage.controller
+    gpio = c.gpio
+    client = c.events.subscribe()
+    samples = []
+    missed = 0
+    try:
+        for i in range(args.edges):
+            n = str(i % args.doors + 1)
+            pin = c.settings['sensor'][n]['pin']
+            level = gpio.input(pin) ^ 1
+            state = "CLOSED" if level == 0 else "OPENING"  # the sensor only tells when the door leaves CLOSED
+            time.sleep(garage.SENSOR_BOUNCETIME / 1000.0)
+            if storm:
+                t0 = gpio.storm(pin, args.bounces, args.bounce_gap / 1000.0, final=level, seed=args.seed + i)
+            else:
+                t0 = time.monotonic()
+                gpio.set_input(pin, level)
+            t1 = wait_for(client, 'door', n, state, args.settle / 1000.0 + 5)
+            if t1 is None:
+                missed += 1
+            else:
+                samples.append(t1 - t0)
+    finally:
+        c.events.unsubscribe(client)
+    name = "edge->state (storm of %d)" % args.bounces if storm else "edge->state"
+    stats(name, samples)
+    if not storm:  # a storm's settle time runs from its first edge
+        stats(name + " - settle", [max(0, s - args.settle / 1000.0) for s in samples])
+    if missed:
+        report("%-36s %d edges never reached a state update" % ('', missed))
+
+
+def bench_presses(garage, args):
+    """
+    Time press_button() to the relay output, and the call itself, which
+    only queues the press. Presses are spaced by the repeat window, and
+    a burst of presses at the end should give a single pulse.
+    """
+    c = garage.controller
+    gpio = c.gpio
+    n = str(args.doors + 1)  # the relay that is not a door
+    pin = c.settings['relay'][n]['pin']
+    active = gpio.HIGH ^ c.settings['relay'][n]['pol']
+    pressed = []
+    gpio.on_output = lambda p, level, ts: pressed.append(ts) if p == pin and level == active else None
+    spacing = c.settings['rly_dup'] / 1000.0 + garage.RELAY_HOLD + garage.RELAY_GAP
+    to_relay = []
+    calls = []
+    for i in range(args.presses):
+        del pressed[:]
+        t0 = time.monotonic()
+        c.press_button(n)
+        t1 = time.monotonic()
+        calls.append(t1 - t0)
+        end = t1 + 1
+        while not pressed and time.monotonic() < end:
+            time.sleep(0.0005)
+        if pressed:
+            to_relay.append(pressed[0] - t0)
+        time.sleep(max(0, spacing - (time.monotonic() - t0)))
+    del pressed[:]
+    for i in range(5):
+        c.press_button(n)
+    time.sleep(spacing)
+    gpio.on_output = None
+    stats("press->relay", to_relay)
+    stats("press_button() call", calls)
+    report("%-36s 5 presses, %d relay pulse(s)" % ("repeated presses", len(pressed)))
+
+
+def bench_notify(garage, args, smtp):
+    """
+    Enqueue notifications with try_notify(), then time their delivery
+    to the SMTP stub.
+    """
+    c = garage.controller
+    start_msgs = smtp.messages
+    start_dropped = c.notifier.dropped
+    t0 = time.monotonic()
+    for i in range(args.notify):
+        c.try_notify(c.subject, "bench %d" % i)
+    t1 = time.monotonic()
+    c.notifier.flush(60)
+    delivered = smtp.messages - start_msgs
+    dropped = c.notifier.dropped - start_dropped
+    t2 = smtp.last_message if delivered else time.monotonic()
+    report("%-36s %d in %.2f ms, %.0f/s; %d dropped (queue full)" %
+          ("try_notify() enqueue", args.notify, (t1 - t0) * 1000, args.notify / max(t1 - t0, 1e-9), dropped))
+    report("%-36s %d in %.2f s, %.1f/s over %d SMTP connection(s)" %
+          ("notification delivery", delivered, t2 - t0, delivered / max(t2 - t0, 1e-9), smtp.connections))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Garage plugin on simulated GPIO.")
+    parser.add_argument('--sip', default='.', help="SIP directory (default: current directory)")
+    parser.add_argument('--doors', type=int, default=2, help="number of doors")
+    parser.add_argument('--settle', type=int, default=100, help="sensor settle time, ms")
+    parser.add_argument('--edges', type=int, default=50, help="sensor edges per run")
+    parser.add_argument('--bounces', type=int, default=20, help="edges in each bounce storm")
+    parser.add_argument('--bounce-gap', type=float, default=2.0, help="max gap between storm edges, ms")
+    parser.add_argument('--presses', type=int, default=10, help="relay presses")
+    parser.add_argument('--notify', type=int, default=30, help="notifications to send")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.abspath(args.sip))
+    smtp = SmtpStub()
+    smtp.start()
+
+    # the plugin keeps its files in ./data, so run in a scratch directory
+    work = tempfile.mkdtemp(prefix='garage-bench-')
+    os.chdir(work)
+    os.mkdir('data')
+    with open('data/garage.json', 'w') as fh:
+        json.dump(bench_settings(args, smtp.port), fh)
+    os.environ['GARAGE_GPIO'] = 'fake'
+
+    import gv
+    import plugins.garage as garage
+    end = time.monotonic() + 10
+    while not getattr(gv, 'gc_started', False) and time.monotonic() < end:
+        time.sleep(0.01)
+    if not gv.gc_started:
+        sys.exit("Garage controller did not start")
+    print("Benchmark work dir: " + work)
+
+    try:
+        bench_edges(garage, args, storm=False)
+        bench_edges(garage, args, storm=True)
+        bench_presses(garage, args)
+        bench_notify(garage, args, smtp)
+    finally:
+        garage.controller.stop()
+        smtp.shutdown()
+    print("\nGarage plugin on FakeGPIO: %d doors, settle %d ms\n" % (args.doors, args.settle))
+    print("\n".join(results))
+
+
+if __name__ == '__main__':
+    main()
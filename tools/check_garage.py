@@ -0,0 +1,519 @@
+#!/usr/bin/env python
+#
+# Check the Garage plugin off a Raspberry Pi.
+#
+# The plugin runs on FakeGPIO (GARAGE_GPIO=fake) in a scratch directory,
+# and we check behaviour that is hard to provoke on a real install:
+#   - a plugin reload hands door state, nag counts and stats over to the
+#     new controller
+#   - the outbox retries failed notifications in order with growing
+#     backoff, two outboxes on one file don't both send a message, and
+#     email queued while the SMTP server is down arrives once it is back
+#   - an SMS or email is sent again only when a kept-alive connection went
+#     stale, never after a timeout
+#   - "Stop Nagging" shows only while an open door has nags left
+#   - on a stand-in pigpio.pi, sensors get a glitch filter and their edges
+#     reach the doors with the right time, across a tick wrap
+#
+# Run it with SIP's modules importable, e.g. from the SIP directory:
+#   cd ~/SIP && python ~/sip_garage_plugin/tools/check_garage.py
+# It exits non-zero if a check fails.
+#
+
+
+import os
+import sys
+import json
+import time
+import argparse
+import importlib
+import tempfile
+import socketserver
+from http.server import BaseHTTPRequestHandler
+from threading import Thread, Lock
+
+from bench_garage import SmtpStub  # tools/ is on sys.path when run as a script
+
+
+###############################################################################
+# Local Twilio stub
+#
+class TwilioStub(socketserver.ThreadingTCPServer):
+    """
+    Minimal HTTP server standing in for the Twilio API. It counts the
+    messages posted, and can hang up on a kept-alive connection after each
+    response ('close') or answer too late ('slow').
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        socketserver.ThreadingTCPServer.__init__(self, (host, port), TwilioHandler)
+        self.lock = Lock()
+        self.messages = 0
+        self.mode = None
+        self.delay = 0
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def handle_error(self, request, client_address):
+        pass  # the client hung up on a 'slow' answer
+
+    def start(self):
+        t = Thread(target=self.serve_forever, name='twilio-stub')
+        t.daemon = True
+        t.start()
+
+
+class TwilioHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with server.lock:
+            server.messages += 1
+            sid = 'SM%d' % server.messages
+        if server.mode == 'slow':
+            time.sleep(server.delay)
+        body = json.dumps({'sid': sid}).encode('ascii')
+        self.send_response(201)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if server.mode == 'close':
+            self.close_connection = True  # without telling the client
+
+
+###############################################################################
+# pigpio stand-in
+#
+class FakePi(object):
+    """
+    Stand-in for a pigpio.pi connection, by BCM gpio number. fire() reports
+    an edge to the callbacks from a thread of its own, as pigpio does. The
+    tick clock (microseconds, wrapping at 2**32) wraps wrap_in seconds
+    after it is made.
+    """
+    def __init__(self, wrap_in=1.0):
+        self.lock = Lock()
+        self.levels = {}
+        self.modes = {}
+        self.glitch = {}     # gpio -> glitch filter, us
+        self.callbacks = {}  # gpio -> FakeCallback
+        self._base = time.monotonic() + wrap_in - 2 ** 32 / 1e6  # time.monotonic() at tick 0
+
+    def get_current_tick(self, at=None):
+        return int(((time.monotonic() if at is None else at) - self._base) * 1e6) & 0xFFFFFFFF
+
+    def set_mode(self, gpio, mode):
+        self.modes[gpio] = mode
+
+    def set_pull_up_down(self, gpio, pud):
+        pass
+
+    def read(self, gpio):
+        return self.levels.get(gpio, 0)
+
+    def write(self, gpio, level):
+        self.levels[gpio] = level
+
+    def set_glitch_filter(self, gpio, steady):
+        self.glitch[gpio] = steady
+
+    def callback(self, gpio, edge, func):
+        cb = FakeCallback(self, gpio, func)
+        with self.lock:
+            self.callbacks[gpio] = cb
+        return cb
+
+    def fire(self, gpio, level):
+        """
+        Set the level of gpio and report the edge. Returns its time.monotonic().
+        """
+        now = time.monotonic()
+        self.levels[gpio] = level
+        with self.lock:
+            cb = self.callbacks.get(gpio)
+        if cb is not None:
+            Thread(target=cb.func, args=(gpio, level, self.get_current_tick(now))).start()
+        return now
+
+
+class FakeCallback(object):
+    def __init__(self, pi, gpio, func):
+        self.pi = pi
+        self.gpio = gpio
+        self.func = func
+
+    def cancel(self):
+        with self.pi.lock:
+            if self.pi.callbacks.get(self.gpio) is self:
+                del self.pi.callbacks[self.gpio]
+
+
+###############################################################################
+# Helpers
+#
+results = []   # printed at the end, after the plugin's own status output
+failures = []
+
+def check(name, ok, detail=''):
+    results.append("%-4s %s%s" % ('ok' if ok else 'FAIL', name, ': ' + detail if detail else ''))
+    if not ok:
+        failures.append(name)
+
+
+def wait_until(cond, timeout):
+    end = time.monotonic() + timeout
+    while not cond():
+        if time.monotonic() > end:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def check_settings(smtp_port):
+    return {
+        'relay'    : {'1': {'ena':1, 'pin':16, 'pol':1, 'prm':1, 'typ':1},
+                      '2': {'ena':1, 'pin':18, 'pol':1, 'prm':1, 'typ':1}},
+        'sensor'   : {'1': {'ena':1, 'pin':11, 'pud':1},
+                      '2': {'ena':1, 'pin':13, 'pud':1}},
+        'sens_stl' : 50,
+        'rly_dup'  : 0,
+        'ntfy_gev' : 'off',
+        'ntfy_gdo' : ['on', 1, 3],
+        'ntfy_gdq' : ['off', 'off', 'off', 'off'],
+        'ntfy_gdc' : ['off', 0, 0],
+        'ntfy_win' : 0,
+        'file_en'  : 'on',
+        'mail_en'  : 'on',
+        'mail_srv' : '127.0.0.1',
+        'mail_port': smtp_port,
+        'mail_ssl' : 'off',
+        'mail_usr' : 'check',
+        'mail_pwd' : 'check',
+        'mail_adr' : 'check@localhost',
+        'twil_en'  : 'off',
+    }
+
+
+###############################################################################
+# Checks
+#
+def check_reload(garage, smtp):
+    """
+    Open both doors, let door 1 nag once, then reload the plugin the way
+    SIP does, with mail queued for a slow SMTP server. stop() must not wait
+    for the server; the new controller must resume the doors with the same
+    event time and nag count and keep the stats of every door; the queued
+    mail must arrive once.
+    """
+    import gv
+    c = garage.controller
+    for n in ('1', '2'):
+        c.gpio.set_input(c.settings['sensor'][n]['pin'], 1)
+    wait_until(lambda: c.door('1').nag_limit < 3, 5)
+    before = dict((n, (c.door(n).state, c.door(n).event_time, c.door(n).nag_limit)) for n in ('1', '2'))
+    nags = dict((n, sum(h['nags'] for h in c.stats.report(n, 24, 1)['hourly'])) for n in ('1', '2'))
+    smtp.delay = 4.0
+    subjects = ["check reload %d" % i for i in range(5)]
+    for subject in subjects:
+        c.queue_notification(subject, "check", time.monotonic())
+    time.sleep(0.1)  # the workers take the first ones
+
+    t0 = time.monotonic()
+    garage = importlib.reload(garage)
+    took = time.monotonic() - t0
+    check("reload: old controller stopped", not c.is_alive() and took < 2 * garage.NOTIFY_STOP_TIMEOUT + 1,
+          "stop() took %.2f s" % took)
+    smtp.delay = 0
+    wait_until(lambda: gv.gc_started, 10)
+    c = garage.controller
+    for n in ('1', '2'):
+        d = c.door(n)
+        check("reload: door %s resumed" % n, (d.state, d.event_time, d.nag_limit) == before[n],
+              "%s -> %s" % (before[n], (d.state, d.event_time, d.nag_limit)))
+        got = sum(h['nags'] for h in c.stats.report(n, 24, 1)['hourly'])
+        check("reload: door %s stats kept" % n, got == nags[n], "%d nags -> %d" % (nags[n], got))
+    wait_until(lambda: len([s for s in smtp.subjects if s.startswith("check reload")]) >= len(subjects), 20)
+    time.sleep(0.5)
+    got = [s for s in smtp.subjects if s.startswith("check reload")]
+    check("reload: queued mail sent once", sorted(got) == subjects, str(got))
+    return garage
+
+
+class SendStub(object):
+    """
+    Outbox send() that fails the first fail calls, and records every
+    message it is given as (time.monotonic(), text, attempts).
+    """
+    def __init__(self, fail=0, delay=0):
+        self.fail = fail
+        self.delay = delay
+        self.lock = Lock()
+        self.calls = []
+        self.sent = []
+
+    def __call__(self, channel, messages):
+        time.sleep(self.delay)
+        with self.lock:
+            self.calls.append([(time.monotonic(), text, attempts) for subject, text, attempts in messages])
+            if self.fail:
+                self.fail -= 1
+                return 0, OSError("stub failure")
+            self.sent.extend(text for subject, text, attempts in messages)
+            return len(messages), None
+
+
+def check_outbox(garage, work):
+    """
+    A channel that fails three times is retried with doubling waits and
+    then drains in order, once. Two outboxes on the same file (as while
+    the plugin reloads) send each message once between them.
+    """
+    report = lambda msg, level: None
+    send = SendStub(fail=3)
+    box = garage.Outbox(send, report, path=os.path.join(work, 'retry.db'), retry=0.2, retry_max=1)
+    box.start()
+    texts = ["message %d" % i for i in range(3)]
+    for text in texts:
+        box.add('stub', 'check', text)
+    wait_until(lambda: not box.pending(), 10)
+    box.stop()
+    check("outbox: drained in order, once", send.sent == texts, str(send.sent))
+    heads = [(ts, attempts) for ts, text, attempts in (c[0] for c in send.calls)]
+    check("outbox: attempts counted", [a for ts, a in heads] == [0, 1, 2, 3], str([a for ts, a in heads]))
+    gaps = [b[0] - a[0] for a, b in zip(heads, heads[1:])]
+    low = 1 - garage.OUTBOX_JITTER
+    expect = [min(1, 0.2 * 2 ** i) for i in range(len(gaps))]
+    check("outbox: backoff grows", all(g >= e * low for g, e in zip(gaps, expect)) and gaps[-1] > gaps[0],
+          ", ".join("%.2f s" % g for g in gaps))
+
+    send = SendStub(delay=0.05)
+    path = os.path.join(work, 'shared.db')
+    boxes = [garage.Outbox(send, report, path=path, batch=2) for i in range(2)]
+    texts = ["shared %d" % i for i in range(10)]
+    for text in texts:
+        boxes[0].add('stub', 'check', text)
+    for b in boxes:
+        b.start()
+    wait_until(lambda: len(send.sent) >= len(texts), 10)
+    time.sleep(0.3)
+    for b in boxes:
+        b.stop()
+    check("outbox: two outboxes send once", send.sent == texts, "%d sends of %d messages" % (len(send.sent), len(texts)))
+
+
+def check_email_outbox(garage, smtp):
+    """
+    Stop the SMTP server, queue mail, start the server again: every message
+    must go through the outbox, EmailNotifier and SmtpSession and arrive
+    once, in order. Returns the new SMTP stub.
+    """
+    c = garage.controller
+    c.outbox.retry, c.outbox.retry_max = 0.2, 1
+    port = smtp.port
+    smtp.stop()
+    subjects = ["check outbox %d" % i for i in range(5)]
+    for subject in subjects:
+        c.queue_notification(subject, "check", time.monotonic())
+    spooled = wait_until(lambda: c.outbox.pending('email') == len(subjects), 10)
+    check("email outbox: spooled while the server is down", spooled, "%d in the outbox" % c.outbox.pending('email'))
+    smtp = SmtpStub(port=port)
+    smtp.start()
+    wait_until(lambda: not c.outbox.pending('email'), 10)
+    got = [s for s in smtp.subjects if s.startswith("check outbox")]
+    check("email outbox: delivered once, in order", got == subjects, str(got))
+    c.outbox.retry, c.outbox.retry_max = garage.OUTBOX_RETRY, garage.OUTBOX_RETRY_MAX
+    return smtp
+
+
+def check_twilio(garage):
+    """
+    A message on a connection the server hung up on is sent again on a
+    new one; a message that timed out waiting for the answer is not.
+    """
+    twilio = TwilioStub()
+    twilio.start()
+    client = garage.TwilioClient('AC0', 'token', twilio.url, timeout=0.5)
+    try:
+        twilio.mode = 'close'
+        client.send_message('+1', '+2', 'first')
+        time.sleep(0.1)  # let the server hang up
+        try:
+            sid = client.send_message('+1', '+2', 'stale').get('sid')
+        except Exception as err:
+            sid = repr(err)
+        check("twilio: stale connection retried", twilio.messages == 2 and sid == 'SM2',
+              "%d messages, %s" % (twilio.messages, sid))
+
+        twilio.mode = None
+        client.send_message('+1', '+2', 'kept alive')
+        twilio.mode, twilio.delay = 'slow', 1.0
+        try:
+            client.send_message('+1', '+2', 'timeout')
+            err = None
+        except Exception as e:
+            err = e
+        time.sleep(1.2)  # the server would see a retry by now
+        check("twilio: timeout not retried", err is not None and twilio.messages == 4,
+              "%d messages, %r" % (twilio.messages, err))
+    finally:
+        client.close()
+        twilio.shutdown()
+
+
+def check_smtp(garage):
+    """
+    A message whose DATA reply times out on a kept-alive connection is not
+    sent again; after the server dropped the connection, the next message
+    goes out once, on a new one.
+    """
+    smtp = SmtpStub()
+    smtp.start()
+    session = garage.SmtpSession()
+    def send(subject):
+        try:
+            session.sendmail('127.0.0.1', smtp.port, 'check', 'check', 'check@localhost',
+                             'Subject: %s\n\ncheck\n' % subject, timeout=0.5, use_ssl=False)
+        except Exception as err:
+            return err
+    try:
+        send('first')
+        smtp.delay = 4.0
+        err = send('timeout')
+        time.sleep(1.2)  # the server would see a resend by now
+        smtp.delay = 0
+        check("smtp: timeout not resent", err is not None and smtp.subjects == ['first', 'timeout'],
+              "%s, %r" % (smtp.subjects, err))
+
+        smtp.hangup = True
+        send('hangup')
+        time.sleep(0.1)  # let the server hang up
+        smtp.hangup = False
+        err = send('stale')
+        check("smtp: stale connection replaced", err is None and smtp.subjects[2:] == ['hangup', 'stale'] and
+              smtp.connections == 3, "%s over %d connections, %r" % (smtp.subjects[2:], smtp.connections, err))
+    finally:
+        session.close()
+        smtp.stop()
+
+
+def check_nag(garage):
+    """
+    With door 2 open and its nags used up, closing door 1 (which re-arms
+    its nag count for the next opening) must not turn the nag flag on.
+    """
+    import gv
+    c = garage.controller
+    c.clear_nag_limit()
+    c.gpio.set_input(c.settings['sensor']['1']['pin'], 0)
+    wait_until(lambda: c.door('1').state == "CLOSED", 5)
+    check("nag: closed door doesn't nag", c.door('2').state == "OPEN" and not gv.gc_nag and
+          not c.api_status(0)['nag'], "door 1 %s, door 2 %s, nag %s" % (c.door('1').state, c.door('2').state, gv.gc_nag))
+
+
+def check_events(garage):
+    """
+    One more event stream than SSE_CLIENTS ends the oldest stream rather
+    than being turned away.
+    """
+    broker = garage.EventBroker()
+    clients = [broker.subscribe() for _ in range(garage.SSE_CLIENTS + 1)]
+    check("events: new stream ends the oldest", None not in clients and clients[0].closed and
+          not any(client.closed for client in clients[1:]),
+          "closed %s" % [client and client.closed for client in clients])
+    broker.close()
+
+
+def check_pigpio(garage):
+    """
+    Run a controller on PigpioGPIO over a FakePi, the way the plugin does
+    with gv.use_pigpio. Each sensor must get a glitch filter of the sensor
+    bouncetime; an edge after the tick clock wrapped must reach door_input
+    as an 'open' event at the time of the edge; stopping must cancel the
+    callbacks and clear the filters.
+    """
+    import gv
+    garage.controller.stop()
+    pi = FakePi(wrap_in=0.5)
+    c = garage.GarageControl(garage.PigpioGPIO(pi))
+    garage.controller = gv.gc_controller = c
+    if not wait_until(lambda: gv.gc_started, 10):
+        check("pigpio: controller started", False)
+        return
+    sensors = [garage.BOARD_TO_BCM[c.settings['sensor'][n]['pin']] for n in ('1', '2')]
+    want = garage.SENSOR_BOUNCETIME * 1000
+    check("pigpio: glitch filters", all(pi.glitch.get(g) == want for g in sensors) and
+          sorted(pi.callbacks) == sorted(sensors), "filters %s, callbacks on %s" % (pi.glitch, sorted(pi.callbacks)))
+
+    seen = []
+    door_input = c.door_input
+    def record(n, event, event_time):
+        seen.append((n, event, event_time))
+        return door_input(n, event, event_time)
+    c.door_input = record
+    for n, g in zip(('1', '2'), sensors):
+        pi.fire(g, 0)
+    time.sleep(0.6)  # past the tick wrap
+    del seen[:]
+    t0 = time.time() - (time.monotonic() - pi.fire(sensors[0], 1))
+    wait_until(lambda: seen, 5)
+    ok = bool(seen) and seen[0][:2] == ('1', 'open') and abs(seen[0][2] - t0) < 0.05
+    check("pigpio: edge reaches door_input", ok,
+          "%s, edge at %+.3f s" % (seen[0][:2], seen[0][2] - t0) if seen else "no door_input call")
+
+    c.stop()
+    check("pigpio: stop cancels callbacks", not pi.callbacks and all(pi.glitch.get(g) == 0 for g in sensors),
+          "filters %s, callbacks on %s" % (pi.glitch, sorted(pi.callbacks)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the Garage plugin on simulated GPIO.")
+    parser.add_argument('--sip', default='.', help="SIP directory (default: current directory)")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.abspath(args.sip))
+
+    # the plugin keeps its files in ./data, so run in a scratch directory
+    work = tempfile.mkdtemp(prefix='garage-check-')
+    os.chdir(work)
+    os.mkdir('data')
+    smtp = SmtpStub()
+    smtp.start()
+    with open('data/garage.json', 'w') as fh:
+        json.dump(check_settings(smtp.port), fh)
+    os.environ['GARAGE_GPIO'] = 'fake'
+
+    import gv
+    import plugins.garage as garage
+    if not wait_until(lambda: getattr(gv, 'gc_started', False), 10):
+        sys.exit("Garage controller did not start")
+    print("Check work dir: " + work)
+
+    try:
+        check_outbox(garage, work)
+        smtp = check_email_outbox(garage, smtp)
+        check_twilio(garage)
+        check_smtp(garage)
+        garage = check_reload(garage, smtp)
+        check_nag(garage)
+        check_events(garage)
+        check_pigpio(garage)
+    finally:
+        garage.controller.stop()
+        smtp.stop()
+    print("\n".join([''] + results))
+    if failures:
+        sys.exit("%d check(s) failed" % len(failures))
+
+
+if __name__ == '__main__':
+    main()